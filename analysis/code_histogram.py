@@ -1,8 +1,8 @@
 from scripts.loading_utils import load_config, load_model
 from scripts.data.custom import CustomTest as CustomDataset
 from scripts.data.utils import custom_collate
-from scripts.analysis_utils import Embedding_Code_converter, HistogramFrequency
-from scripts.plotting_utils import get_fig_pth, Histogram_plotter, save_to_txt
+from scripts.analysis_utils import Embedding_Code_converter, HistogramFrequency, get_histograms_path, get_histograms_store_path, get_ckpt_hash, get_group_membership, get_group_counts, save_histograms, load_histograms, load_histograms_metadata, get_counts_hash, HISTOGRAMS_METADATA_FILE
+from scripts.plotting_utils import get_fig_pth, Histogram_plotter, render_histogram_plots, save_to_txt
 import scripts.constants as CONSTANTS
 
 from torch.utils.data import DataLoader
@@ -11,7 +11,6 @@ from tqdm import tqdm
 import os
 from omegaconf import OmegaConf
 import argparse
-from operator import add
 
 ##########
 
@@ -25,7 +24,10 @@ def main(configs_yaml):
     num_workers = configs_yaml.num_workers
     size = configs_yaml.size
     visualize_histograms = configs_yaml.visualize_histograms
+    plot_num_workers = configs_yaml.plot_num_workers
+    plot_preview = configs_yaml.plot_preview
     per_phylo_level = configs_yaml.per_phylo_level
+    histograms_path = configs_yaml.histograms_path
 
     unique_skipped_labels = configs_yaml.unique_skipped_labels
 
@@ -41,23 +43,22 @@ def main(configs_yaml):
     # create the converter.
     item = next(iter(dataloader_noskippedlabels))
     img = model.get_input(item, model.image_key).to(DEVICE)
-    lbl = item[CONSTANTS.DISENTANGLER_CLASS_OUTPUT]
-    _, _, _, in_out_disentangler = model(img)
+    q_phylo_output, q_phylo_output_nonattribute, _, encoder_outputs, _, _, _, _ = model.encode(img)
     
-    q_phylo_output = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_OUTPUT]
-    converter = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_index, model.phylo_disentangler.quantize.embedding, q_phylo_output[0, :, :, :].shape)
-    q_phylo_output_indices = converter.get_phylo_codes(q_phylo_output)
+    converter = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_indices, model.phylo_disentangler.quantize.embedding, q_phylo_output[0, :, :, :].shape)
+    q_phylo_output_indices = encoder_outputs[CONSTANTS.QUANTIZED_PHYLO_CODES]
 
-    q_phylo_output_nonattribute = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT]
-    converter_nonattribute = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_index, model.phylo_disentangler.quantize.embedding, q_phylo_output_nonattribute[0, :, :, :].shape)
-    q_phylo_output_nonattribute_indices = converter.get_phylo_codes(q_phylo_output_nonattribute)
+    converter_nonattribute = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_indices, model.phylo_disentangler.quantize.embedding, q_phylo_output_nonattribute[0, :, :, :].shape)
+    q_phylo_output_nonattribute_indices = encoder_outputs[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_CODES]
     
     # create histogram counter
-    hist_freq = HistogramFrequency(len(dataset.indx_to_label.keys()), q_phylo_output_indices.shape[1], q_phylo_output_nonattribute_indices.shape[1])
+    hist_freq = HistogramFrequency(len(dataset.indx_to_label.keys()), q_phylo_output_indices.shape[1], model.phylo_disentangler.n_embed, q_phylo_output_nonattribute_indices.shape[1])
                     
         
     # collect values   
-    hist_file_path = os.path.join(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER), CONSTANTS.HISTOGRAMS_FILE)
+    histograms_folder = get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER)
+    store_path = get_histograms_store_path(histograms_folder, histograms_path)
+    hist_file_path = histograms_path if histograms_path is not None else get_histograms_path(histograms_folder)
     try:
         hist_freq.load_from_file(hist_file_path)
     except (OSError, IOError) as e:
@@ -66,18 +67,23 @@ def main(configs_yaml):
             img = model.get_input(item, model.image_key).to(DEVICE)
             lbl = item[CONSTANTS.DISENTANGLER_CLASS_OUTPUT]
             
-            # get output
-            _, _, _, in_out_disentangler = model(img)
+            # get codes. Only the encoder is needed, no decoding.
+            _, _, _, encoder_outputs, _, _, _, _ = model.encode(img)
             
-            q_phylo_output = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_OUTPUT]
-            q_phylo_output_indices = converter.get_phylo_codes(q_phylo_output)
-            
-            q_phylo_output_nonattribute = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT]
-            q_phylo_nonattribute_output_indices = converter_nonattribute.get_phylo_codes(q_phylo_output_nonattribute)
+            q_phylo_output_indices = encoder_outputs[CONSTANTS.QUANTIZED_PHYLO_CODES]
+            q_phylo_nonattribute_output_indices = encoder_outputs[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_CODES]
             
+            # accumulate the whole batch at once
             hist_freq.set_location_frequencies(lbl, q_phylo_output_indices, q_phylo_nonattribute_output_indices)
         
-        hist_freq.save_to_file(hist_file_path)
+    
+    # newly calculated or legacy histograms are written to the store
+    if not os.path.isdir(store_path):
+        hist_freq.metadata = {
+            'ckpt_hash': get_ckpt_hash(ckpt_path),
+            'labels': [dataset.indx_to_label[i] for i in range(len(dataset.indx_to_label.keys()))],
+        }
+        hist_freq.save_to_file(store_path)
          
          
     
@@ -91,7 +97,7 @@ def main(configs_yaml):
         
         for level in range(n_phylolevels-1): # last level already plotted.
             relative_distance =  model.phylo_disentangler.loss_phylo.get_relative_distance_for_level(level)
-            species_groups = model.phylo_disentangler.loss_phylo.phylogeny.get_species_groups(relative_distance)
+            species_groups = list(model.phylo_disentangler.loss_phylo.phylogeny.get_species_groups(relative_distance))
             species_groups_arr.append(species_groups)
             
             species_groups_list = list(species_groups)
@@ -99,7 +105,7 @@ def main(configs_yaml):
         
         group_levels_attr_hist, group_levels_non_attr_hist = build_group_histograms(hist_freq,
                             species_groups_arr, n_phylolevels,
-                            dataset.labels_to_idx)
+                            dataset.labels_to_idx, store_path)
     
         
             
@@ -108,47 +114,55 @@ def main(configs_yaml):
     if visualize_histograms:
         print('plotting histograms...')
         
-        hist_plotter = Histogram_plotter(codes_per_phylolevel, n_phylolevels, model.phylo_disentangler.n_embed, converter, dataset.indx_to_label, ckpt_path, CONSTANTS.HISTOGRAMS_FOLDER)
-        hist_plotter_non_attribute = Histogram_plotter(codes_per_phylolevel, n_levels_nonattribute, model.phylo_disentangler.n_embed, converter_nonattribute, dataset.indx_to_label, ckpt_path, CONSTANTS.HISTOGRAMS_FOLDER)
+        hist_plotter = Histogram_plotter(codes_per_phylolevel, n_phylolevels, model.phylo_disentangler.n_embed, converter, dataset.indx_to_label, ckpt_path, CONSTANTS.HISTOGRAMS_FOLDER, preview=plot_preview)
+        hist_plotter_non_attribute = Histogram_plotter(codes_per_phylolevel, n_levels_nonattribute, model.phylo_disentangler.n_embed, converter_nonattribute, dataset.indx_to_label, ckpt_path, CONSTANTS.HISTOGRAMS_FOLDER, preview=plot_preview)
         
-        for species_indx, species_arr in tqdm(enumerate(hist_freq.hist_arr)):         
-            hist_plotter.plot_histograms(species_arr, species_indx, is_nonattribute=False)
-            hist_plotter_non_attribute.plot_histograms(hist_freq.hist_arr_nonattr[species_indx], species_indx, is_nonattribute=True)
+        # plots newer than the histograms they show are skipped.
+        plot_jobs = []
+        source_path = os.path.join(store_path, HISTOGRAMS_METADATA_FILE)
+        for species_indx, species_arr in enumerate(hist_freq.hist_arr):         
+            plot_jobs.append(hist_plotter.get_plot_job(species_arr, species_indx, is_nonattribute=False, source_path=source_path))
+            plot_jobs.append(hist_plotter_non_attribute.get_plot_job(hist_freq.hist_arr_nonattr[species_indx], species_indx, is_nonattribute=True, source_path=source_path))
         
 
         if per_phylo_level:
             for level in range(n_phylolevels-1): # last level already plotted.
+                source_path = os.path.join(store_path, "group-level-{}".format(level), HISTOGRAMS_METADATA_FILE)
 
-                for species_group in tqdm(species_groups_arr[level]):
+                for group_indx, species_group in enumerate(species_groups_arr[level]):
                     
-                    hist_plotter.plot_histograms(group_levels_attr_hist[level][species_group[0]], dataset.labels_to_idx[species_group[0]], is_nonattribute=False, prefix="group-level-{}".format(level))
-                    hist_plotter_non_attribute.plot_histograms(group_levels_non_attr_hist[level][species_group[0]], dataset.labels_to_idx[species_group[0]], is_nonattribute=True, prefix="group-level-{}".format(level))
+                    plot_jobs.append(hist_plotter.get_plot_job(group_levels_attr_hist[level][group_indx], dataset.labels_to_idx[species_group[0]], is_nonattribute=False, prefix="group-level-{}".format(level), source_path=source_path))
+                    plot_jobs.append(hist_plotter_non_attribute.get_plot_job(group_levels_non_attr_hist[level][group_indx], dataset.labels_to_idx[species_group[0]], is_nonattribute=True, prefix="group-level-{}".format(level), source_path=source_path))
+        
+        render_histogram_plots(plot_jobs, num_workers=plot_num_workers)
 
 
 
 # Gives structure of shape:
-# [num_of_levels-1][species][code]
+# [num_of_levels-1] -> (groups, code_location, n_embed) counts, groups ordered as in species_groups_arr[level]
+# Each level is a (groups, species) membership matrix times the species counts.
+# The group counts of each level are cached in the species histogram store, next to the species counts.
 def build_group_histograms(hist_freq,
                            species_groups_arr, num_of_levels,
-                           labels_to_idx):
+                           labels_to_idx, store_path=None):
     group_levels_attr = []
     group_levels_non_attr = []
+    species_counts_hash = get_counts_hash(hist_freq.hist_arr, hist_freq.hist_arr_nonattr)
     
     for level in range(num_of_levels-1): # last level already plotted.
-
-        group_arr ={}
-        group_arr_nonattr ={}
+        species_groups = [list(species_group) for species_group in species_groups_arr[level]]
+        group_store_path = os.path.join(store_path, "group-level-{}".format(level)) if store_path is not None else None
         
-        for species_group in species_groups_arr[level]:
-            
-            for indx, species in enumerate(species_group):
-                species_indx = labels_to_idx[species]
-                if indx == 0:
-                    group_arr[species] = hist_freq.hist_arr[species_indx]
-                    group_arr_nonattr[species] = hist_freq.hist_arr_nonattr[species_indx]
-                else:
-                    group_arr[species_group[0]] = list(map(add, group_arr[species_group[0]], hist_freq.hist_arr[species_indx]))
-                    group_arr_nonattr[species_group[0]] =  list(map(add, group_arr_nonattr[species_group[0]], hist_freq.hist_arr_nonattr[species_indx]))
+        # reuse the cached group counts if they were built from the same groups and species counts.
+        group_metadata = load_histograms_metadata(group_store_path) if group_store_path is not None and os.path.isdir(group_store_path) else {}
+        if group_metadata.get('groups') == species_groups and group_metadata.get('species_counts_hash') == species_counts_hash:
+            group_arr, group_arr_nonattr = load_histograms(group_store_path, hist_freq.n_embed)
+        else:
+            membership = get_group_membership(species_groups, labels_to_idx, hist_freq.hist_arr.shape[0])
+            group_arr = get_group_counts(membership, hist_freq.hist_arr)
+            group_arr_nonattr = get_group_counts(membership, hist_freq.hist_arr_nonattr) if hist_freq.hist_arr_nonattr is not None else None
+            if group_store_path is not None:
+                save_histograms(group_store_path, group_arr, group_arr_nonattr, {**hist_freq.metadata, 'groups': species_groups, 'species_counts_hash': species_counts_hash})
                         
         group_levels_attr.append(group_arr)
         group_levels_non_attr.append(group_arr_nonattr)
@@ -1,7 +1,7 @@
 from scripts.loading_utils import load_config, load_model
 from scripts.data.custom import CustomTest as CustomDataset
 from scripts.data.utils import custom_collate
-from scripts.analysis_utils import Embedding_Code_converter, HistogramFrequency
+from scripts.analysis_utils import Embedding_Code_converter, HistogramFrequency, get_histograms_path, get_histograms_store_path, get_ckpt_hash
 from scripts.models.vqgan import VQModel
 from scripts.plotting_utils import get_fig_pth
 import scripts.constants as CONSTANTS
@@ -15,6 +15,13 @@ import argparse
 
 ##########
 
+# (n, 256, 16, 16) -> (n, 256) codes of the whole batch
+def get_codes(model, converter_phylo, q_phylo_output, indices):
+    if model.quantize.remap is not None:
+        # quantizer indices are remapped. Search the codebook instead.
+        return converter_phylo.get_phylo_codes(q_phylo_output)
+    return converter_phylo.get_phylo_codes_from_indices(indices, q_phylo_output.shape[0])
+
 @torch.no_grad()
 def main(configs_yaml):
     yaml_path = configs_yaml.yaml_path
@@ -24,6 +31,7 @@ def main(configs_yaml):
     file_list_path = configs_yaml.file_list_path    
     num_workers = configs_yaml.num_workers
     size = configs_yaml.size
+    histograms_path = configs_yaml.histograms_path
 
     # load image
     dataset = CustomDataset(size, file_list_path, add_labels=True)
@@ -36,16 +44,17 @@ def main(configs_yaml):
     # create the converter.
     item = next(iter(dataloader))
     img = model.get_input(item, model.image_key).to(DEVICE)
-    lbl = item[CONSTANTS.DISENTANGLER_CLASS_OUTPUT]
-    q_phylo_output = model.encode(img)[0]
-    converter_phylo = Embedding_Code_converter(model.quantize.get_codebook_entry_index, model.quantize.embedding, q_phylo_output[0, :, :, :].shape)
+    q_phylo_output, indices = model.encode_to_indices(img)
+    converter_phylo = Embedding_Code_converter(model.quantize.get_codebook_entry_indices, model.quantize.embedding, q_phylo_output[0, :, :, :].shape)
     
     # create histogram frequency counter
-    q_phylo_output_indices = converter_phylo.get_phylo_codes(q_phylo_output[0, :, :, :].unsqueeze(0), verify=False)
-    hist_freq = HistogramFrequency(len(dataset.indx_to_label.keys()), q_phylo_output_indices.shape[1])
+    q_phylo_output_indices = get_codes(model, converter_phylo, q_phylo_output, indices)
+    hist_freq = HistogramFrequency(len(dataset.indx_to_label.keys()), q_phylo_output_indices.shape[1], model.quantize.n_e)
         
     # collect values   
-    hist_file_path = os.path.join(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER), CONSTANTS.HISTOGRAMS_FILE)
+    histograms_folder = get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER)
+    store_path = get_histograms_store_path(histograms_folder, histograms_path)
+    hist_file_path = histograms_path if histograms_path is not None else get_histograms_path(histograms_folder)
     try:
         hist_freq.load_from_file(hist_file_path) 
     except (OSError, IOError) as e:
@@ -55,14 +64,21 @@ def main(configs_yaml):
             lbl = item[CONSTANTS.DISENTANGLER_CLASS_OUTPUT]
             
             # get output
-            q_phylo_output = model.encode(img)[0]
-            # reshape 
-            q_phylo_output_indices = converter_phylo.get_phylo_codes(q_phylo_output[0, :, :, :].unsqueeze(0), verify=False)
+            q_phylo_output, indices = model.encode_to_indices(img)
+            q_phylo_output_indices = get_codes(model, converter_phylo, q_phylo_output, indices)
             
+            # accumulate the whole batch at once
             hist_freq.set_location_frequencies(lbl, q_phylo_output_indices)
 
             
-        hist_freq.save_to_file(hist_file_path)
+    
+    # newly calculated or legacy histograms are written to the store
+    if not os.path.isdir(store_path):
+        hist_freq.metadata = {
+            'ckpt_hash': get_ckpt_hash(ckpt_path),
+            'labels': [dataset.indx_to_label[i] for i in range(len(dataset.indx_to_label.keys()))],
+        }
+        hist_freq.save_to_file(store_path)
 
          
 
@@ -1,6 +1,6 @@
 from scripts.loading_utils import load_config, load_model
 from scripts.data.custom import CustomTest as CustomDataset
-from scripts.analysis_utils import Embedding_Code_converter, HistogramParser
+from scripts.analysis_utils import Embedding_Code_converter, HistogramParser, load_histograms, get_histograms_path
 from scripts.plotting_utils import dump_to_json, get_fig_pth
 import scripts.constants as CONSTANTS
 
@@ -8,7 +8,6 @@ import torch
 import os
 from omegaconf import OmegaConf
 import argparse
-import pickle
 
 ##########
 
@@ -78,21 +77,22 @@ def main(configs_yaml):
     model = load_model(config, ckpt_path=ckpt_path, cuda=(DEVICE is not None))
     
     # load histograms
-    histograms_file = os.path.join(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER), CONSTANTS.HISTOGRAMS_FILE)
+    histograms_file = get_histograms_path(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER))
     histogram_file_exists = os.path.exists(histograms_file)
     if not histogram_file_exists:
         raise "histograms have not been generated. Run code_histogram.py first! Defaulting to index ordering"
-    hist_arr, hist_arr_nonattr = pickle.load(open(histograms_file, "rb"))
-    
-    # parse histograms
-    hist_parser = HistogramParser(model)
-    converter = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_index, model.phylo_disentangler.quantize.embedding, (1, model.phylo_disentangler.embed_dim, hist_parser.codes_per_phylolevel, hist_parser.n_phylolevels))
     
+    # only read the two species
     species1_indx = dataset.labels_to_idx[species1_name]
     species2_indx = dataset.labels_to_idx[species2_name]
+    hist_arr, hist_arr_nonattr = load_histograms(histograms_file, model.phylo_disentangler.n_embed, classes=[species1_indx, species2_indx])
+    
+    # parse histograms
+    hist_parser = HistogramParser(model)
+    converter = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_indices, model.phylo_disentangler.quantize.embedding, (1, model.phylo_disentangler.embed_dim, hist_parser.codes_per_phylolevel, hist_parser.n_phylolevels))
     
-    attr_info = hist_parser.get_distances(hist_arr, species1_indx, species2_indx)
-    nonattr_info = hist_parser.get_distances(hist_arr_nonattr, species1_indx, species2_indx)
+    attr_info = hist_parser.get_distances(hist_arr, 0, 1)
+    nonattr_info = hist_parser.get_distances(hist_arr_nonattr, 0, 1)
     
     generate_report([species1_name, species2_name], ckpt_path, attr_info, nonattr_info, converter, hist_parser)
     
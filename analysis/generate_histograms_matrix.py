@@ -1,5 +1,5 @@
 from scripts.loading_utils import load_config, load_model
-from scripts.analysis_utils import Embedding_Code_converter, HistogramParser
+from scripts.analysis_utils import Embedding_Code_converter, HistogramParser, load_histograms, get_histograms_path, get_all_pairs_js_distances, reduce_distances_by_masks
 from scripts.plotting_utils import get_fig_pth, plot_heatmap
 import scripts.constants as CONSTANTS
 
@@ -7,7 +7,6 @@ import torch
 import os
 from omegaconf import OmegaConf
 import argparse
-import pickle
 
 #*****************
 
@@ -16,42 +15,37 @@ def main(configs_yaml):
     yaml_path = configs_yaml.yaml_path
     ckpt_path = configs_yaml.ckpt_path
     DEVICE = configs_yaml.DEVICE
+    block_size = configs_yaml.block_size
+    num_workers = configs_yaml.num_workers
 
     # Load model
     config = load_config(yaml_path, display=False)
     model = load_model(config, ckpt_path=ckpt_path, cuda=(DEVICE is not None))
 
     # load histograms
-    histograms_file = os.path.join(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER), CONSTANTS.HISTOGRAMS_FILE)
+    histograms_file = get_histograms_path(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER))
     histogram_file_exists = os.path.exists(histograms_file)
     if not histogram_file_exists:
         raise "histograms have not been generated. Run code_histogram.py first! Defaulting to index ordering"
-    hist_arr, hist_arr_nonattr = pickle.load(open(histograms_file, "rb"))
+    hist_arr, hist_arr_nonattr = load_histograms(histograms_file, model.phylo_disentangler.n_embed)
     
     # parse histograms and create phylo converter
     hist_parser = HistogramParser(model)
-    converter = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_index, model.phylo_disentangler.quantize.embedding, (1, model.phylo_disentangler.embed_dim, hist_parser.codes_per_phylolevel, hist_parser.n_phylolevels))
+    converter = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_indices, model.phylo_disentangler.quantize.embedding, (1, model.phylo_disentangler.embed_dim, hist_parser.codes_per_phylolevel, hist_parser.n_phylolevels))
+    
+    # claculate distances of all species pairs: (species, species, locations)
+    if DEVICE is not None:
+        hist_arr, hist_arr_nonattr = hist_arr.to(DEVICE), hist_arr_nonattr.to(DEVICE)
+    attr_distances = get_all_pairs_js_distances(hist_arr, block_size=block_size, num_workers=num_workers)
+    nonattr_distances = get_all_pairs_js_distances(hist_arr_nonattr, block_size=block_size, num_workers=num_workers)
+    
+    # average per level: [non-attributes, level 0, ..., level n_phylolevels-2, all attributes]
+    level_masks = converter.get_sub_level_masks(hist_parser.n_phylolevels)
+    jsdistances = torch.cat([
+        torch.mean(nonattr_distances, dim=-1, keepdim=True),
+        reduce_distances_by_masks(attr_distances, level_masks),
+    ], dim=-1)
     
-    # claculate distances
-    jsdistances = torch.zeros([len(hist_arr), len(hist_arr), hist_parser.n_phylolevels+1])
-    for species1_indx in range(len(hist_arr)):
-        for species2_indx in range(len(hist_arr)):
-            if species2_indx<species1_indx:
-                continue
-            
-            attr_distances, _, _ = hist_parser.get_distances(hist_arr, species1_indx, species2_indx)
-            nonattr_distances, _, _ = hist_parser.get_distances(hist_arr_nonattr, species1_indx, species2_indx)
-            
-            average_distance_nonattr = torch.mean(nonattr_distances)
-            jsdistances[species1_indx, species2_indx, 0] = jsdistances[species2_indx, species1_indx, 0] = average_distance_nonattr
-            
-            for i in range(hist_parser.n_phylolevels-1):
-                sub_distances = converter.get_sub_level(attr_distances.unsqueeze(0), i)
-                jsdistances[species1_indx, species2_indx, i+1]= jsdistances[species2_indx, species1_indx, i+1] = torch.mean(sub_distances)
-                
-            average_distance_attr = torch.mean(attr_distances)
-            jsdistances[species1_indx, species2_indx, -1]= jsdistances[species2_indx, species1_indx, -1] = average_distance_attr
-            
     plot_heatmap(jsdistances[:,:,0].cpu(), ckpt_path, title='js-divergence for non-attributes', postfix=CONSTANTS.TEST_DIR)
     for i in range(hist_parser.n_phylolevels-1):
         plot_heatmap(jsdistances[:,:,i+1].cpu(), ckpt_path, title='js-divergence for phylo attributes for level {}'.format(i), postfix=CONSTANTS.TEST_DIR)
@@ -40,7 +40,7 @@ def main(configs_yaml):
     if not model.be_unconditional:
         indices = range(len(dataset.indx_to_label))
         if model.cond_stage_model.phylo_mapper is not None:
-            indices = sorted(list(set(model.cond_stage_model.phylo_mapper.get_original_indexing_truth(indices))))
+            indices = torch.unique(model.cond_stage_model.phylo_mapper.get_original_indexing_truth(torch.arange(len(indices)))).tolist()
 
         print('generating images...')
 
@@ -74,8 +74,8 @@ def generate_images(index, lbl,
     n_levels_non_attribute = model.first_stage_model.phylo_disentangler.n_levels_non_attribute
     attr_codes_range = codes_per_phylolevel*n_phylolevels
         
-    converter = Embedding_Code_converter(model.first_stage_model.phylo_disentangler.quantize.get_codebook_entry_index, model.first_stage_model.phylo_disentangler.quantize.embedding, (embed_dim, codes_per_phylolevel, n_phylolevels))
-    converter_nonattribute = Embedding_Code_converter(model.first_stage_model.phylo_disentangler.quantize.get_codebook_entry_index, model.first_stage_model.phylo_disentangler.quantize.embedding, (embed_dim, codes_per_phylolevel, n_levels_non_attribute))
+    converter = Embedding_Code_converter(model.first_stage_model.phylo_disentangler.quantize.get_codebook_entry_indices, model.first_stage_model.phylo_disentangler.quantize.embedding, (embed_dim, codes_per_phylolevel, n_phylolevels))
+    converter_nonattribute = Embedding_Code_converter(model.first_stage_model.phylo_disentangler.quantize.get_codebook_entry_indices, model.first_stage_model.phylo_disentangler.quantize.embedding, (embed_dim, codes_per_phylolevel, n_levels_non_attribute))
 
     # construct the label conditioning
     generated_imgs = []
@@ -0,0 +1,34 @@
+from scripts.analysis_utils import merge_histograms
+
+from omegaconf import OmegaConf
+import argparse
+
+##########
+
+def main(configs_yaml):
+    histogram_stores = list(configs_yaml.histogram_stores)
+    output_path = configs_yaml.output_path
+    
+    # sum the per-shard counts of the same checkpoint into one store
+    merge_histograms(histogram_stores, output_path)
+    
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--config",
+        type=str,
+        nargs="?",
+        const=True,
+        default="analysis/configs/merge_histograms.yaml",
+    )
+    
+    cfg, _ = parser.parse_known_args()
+    configs = OmegaConf.load(cfg.config)
+    cli = OmegaConf.from_cli()
+    config = OmegaConf.merge(configs, cli)
+    print(config)
+    
+    main(config)
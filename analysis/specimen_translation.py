@@ -1,5 +1,5 @@
 
-from scripts.analysis_utils import Embedding_Code_converter
+from scripts.analysis_utils import Embedding_Code_converter, get_histograms_path, get_entropy_tables
 from scripts.loading_utils import load_config, load_model
 from scripts.data.custom import CustomTest as CustomDataset
 import scripts.constants as CONSTANTS
@@ -7,7 +7,6 @@ from scripts.models.phyloautoencoder import PhyloVQVAE
 from scripts.plotting_utils import get_fig_pth
 
 import os
-import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import ImageGrid
@@ -16,19 +15,6 @@ from omegaconf import OmegaConf
 import argparse
 import tqdm
 from pathlib import Path
-from scipy.stats import entropy
-
-
-# indexing of hist_arr: [code_location][raw list of codes of that location from all images]
-# lowest entropy to highest entropy
-def get_entropy_ordering(hist_arr_for_species):
-    entropies = []
-    for codes_forcode_location in hist_arr_for_species:
-        value,counts = np.unique(codes_forcode_location, return_counts=True)
-        entropies.append(entropy(counts))
-    reverse_ordered_entropy_indices = np.argsort(entropies)
-    # print(entropies, reverse_ordered_entropy_indices)
-    return reverse_ordered_entropy_indices
 
 
 class KeyImageEntropyHelper:
@@ -88,6 +74,13 @@ def main(configs_yaml):
     get_code_reshaped_index = model.phylo_disentangler.embedding_converter.get_code_reshaped_index
     n_phylocodes = model.phylo_disentangler.n_phylolevels*model.phylo_disentangler.codes_per_phylolevel
     
+    # Get code and location ordering tables of all species
+    histograms_file = get_histograms_path(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER))
+    histogram_file_exists = os.path.exists(histograms_file)
+    if not histogram_file_exists:
+        raise "histograms have not been generated. Run code_histogram.py first! Defaulting to index ordering"
+    entropy_tables = get_entropy_tables(histograms_file, model.phylo_disentangler.n_embed, model.phylo_disentangler.n_phylolevels)
+    
     for indx__ in tqdm.tqdm(range(count)):
         image_index1 = image_index1_+indx__
         image_index2 = image_index2_+indx__
@@ -115,11 +108,11 @@ def main(configs_yaml):
             q_non_attr = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT] 
 
             if converter_phylo is None:
-                converter_phylo = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_index, model.phylo_disentangler.quantize.embedding, q_phylo[0, :, :, :].shape)
-                converter_nonattr = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_index, model.phylo_disentangler.quantize.embedding, q_non_attr[0, :, :, :].shape)
+                converter_phylo = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_indices, model.phylo_disentangler.quantize.embedding, q_phylo[0, :, :, :].shape)
+                converter_nonattr = Embedding_Code_converter(model.phylo_disentangler.quantize.get_codebook_entry_indices, model.phylo_disentangler.quantize.embedding, q_non_attr[0, :, :, :].shape)
             
-            all_code_indices_phylo = converter_phylo.get_phylo_codes(q_phylo[0, :, :, :].unsqueeze(0))
-            all_code_indices_nonattr = converter_nonattr.get_phylo_codes(q_non_attr[0, :, :, :].unsqueeze(0))
+            all_code_indices_phylo = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_CODES][:1]
+            all_code_indices_nonattr = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_CODES][:1]
             if len_phylo is None:
                 len_phylo = all_code_indices_phylo.view(1, -1).shape[-1]
             
@@ -137,33 +130,9 @@ def main(configs_yaml):
         code1 = codes[0]
         code2 = codes[1]
 
-        # Get code and location ordering
-        histograms_file = os.path.join(get_fig_pth(ckpt_path, postfix=CONSTANTS.HISTOGRAMS_FOLDER), CONSTANTS.HISTOGRAMS_FILE)
-        histogram_file_exists = os.path.exists(histograms_file)
-        if not histogram_file_exists:
-            raise "histograms have not been generated. Run code_histogram.py first! Defaulting to index ordering"
-        hist_arr, hist_arr_nonattr = pickle.load(open(histograms_file, "rb"))
-        
-        # by entrop over levels
+        # by entrop over levels of the target species
         target_class = classes[-1]
-        entropy_nonphylo = np.flip(get_entropy_ordering(hist_arr_nonattr[target_class]) + n_phylocodes)
-        hist_phylo = hist_arr[target_class]
-        hist_levels = []
-        for i in range(n_phylocodes):
-            hist_levels.append([])
-        for i in range(len(hist_phylo)):
-            relative_indx, lvl = get_code_reshaped_index(i)
-            hist_levels[lvl].append(hist_phylo[i])
-        for lvl in range(model.phylo_disentangler.n_phylolevels):
-            hist_levels[lvl] = np.flip(get_entropy_ordering(hist_levels[lvl]))
-        entropy_phylo = np.zeros(len(hist_phylo), dtype=int)
-        o = 0
-        for lvl in range(model.phylo_disentangler.n_phylolevels):
-            for relative_index in range(model.phylo_disentangler.codes_per_phylolevel):
-                abs_indx = get_code_reshaped_index(hist_levels[lvl][relative_index], lvl)
-                entropy_phylo[o] = abs_indx
-                o = o+1
-        order_ = np.concatenate((entropy_nonphylo, entropy_phylo))
+        order_ = entropy_tables['orderings'][target_class]
 
         if show_only_key_imgs:
             key_image_helper = KeyImageEntropyHelper(model.phylo_disentangler.codes_per_phylolevel, model.phylo_disentangler.n_phylolevels, model.phylo_disentangler.n_levels_non_attribute, get_code_reshaped_index)
@@ -79,7 +79,7 @@ def main(configs_yaml):
             processed_img = torch.Tensor(specimen['image']).unsqueeze(0).to(DEVICE)
             processed_img = processed_img.permute(0, 3, 1, 2).to(memory_format=torch.contiguous_format)
             
-            quant, diff, info = model.encode(processed_img)
+            quant, all_code = model.encode_to_indices(processed_img)
             dec_image = model.decode(quant)
         
             dec_images.append(dec_image)
@@ -88,7 +88,6 @@ def main(configs_yaml):
             else:
                 dec_images.append(processed_img)
                 
-            all_code = info[2]
             codes.append(all_code)
             
             species_index = specimen['class']
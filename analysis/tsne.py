@@ -35,7 +35,7 @@ def get_output(model, image):
         _, _, _, in_out_disentangler = model(image)
         return in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_OUTPUT]
     elif type(model) == VQModel: 
-        quant, _, _ = model.encode(image)
+        quant, _ = model.encode_to_indices(image)
         return quant
     elif type(model) == CWmodelVQGAN:
         h = model.encoder(image)
@@ -101,12 +101,8 @@ def get_tsne(dataloader, model, path,
 
 
 def avg_distances(fine_label, indexes, phylogeny, dataset):
-    dist = 0
-    label_list = phylogeny.getLabelList()
-    for i in indexes:
-        lbl = dataset[i]['class']
-        dist = dist + phylogeny.get_distance(label_list[fine_label], label_list[lbl])
-    result = dist/len(indexes)
+    lbls = np.array([dataset[i]['class'] for i in indexes])
+    result = phylogeny.get_distances(int(fine_label), lbls).mean()
     return result
 
 
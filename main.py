@@ -336,20 +336,19 @@ class ImageLogger(Callback):
             if is_train:
                 pl_module.eval()
 
-            embeddings = {
-                'phylo': pl_module.validation_epoch_end_zq_phylos,
-                'nonphylo': pl_module.validation_epoch_end_zq_nonphylos
+            codes = {
+                'phylo': pl_module.validation_epoch_end_zq_phylo_codes,
+                'nonphylo': pl_module.validation_epoch_end_zq_nonphylo_codes
             }
             embedding_dist = {
                 'phylo': None,
                 'nonphylo': None
             }
-            for i in embeddings.keys():
+            for i in codes.keys():
                 classes =  pl_module.validation_epoch_end_classes
                 classnames =  pl_module.validation_epoch_end_classnames
                 sorting_indices = np.argsort(classes.cpu())
-                sorted_zq = embeddings[i][sorting_indices, :]
-                sorted_zq_codes = pl_module.phylo_disentangler.embedding_converter.get_phylo_codes(sorted_zq)
+                sorted_zq_codes = codes[i][sorting_indices, :]
                 reverse_shaped_sorted_zq_codes = pl_module.phylo_disentangler.embedding_converter.reshape_code(sorted_zq_codes, reverse=True)
                 sorted_class_names_according_to_class_indx = [classnames[i] for i in sorting_indices]
                 sub_sorted_zq_codes = pl_module.phylo_disentangler.embedding_converter.reshape_code(reverse_shaped_sorted_zq_codes)
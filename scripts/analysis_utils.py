@@ -1,8 +1,13 @@
 from scripts.modules.losses.phyloloss import Species_sibling_finder, get_loss_name, get_relative_distance_for_level, parse_phyloDistances
+import scripts.constants as CONSTANTS
 
 import torch
-from scipy.spatial import distance as js_distance
+import numpy as np
+import os
+import json
+import hashlib
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 EPS=1e-10
 
@@ -19,12 +24,12 @@ def get_phylomapper_from_config(phylogeny, phyloDistances_string, level):
     
     outputname = get_loss_name(phylo_distances, level)
     
-    return PhylogenyMapper(level, siblingfinder.map_speciesId_siblingVector, mlb, outputname)
+    return PhylogenyMapper(level, siblingfinder.map_speciesId_siblingVector, mlb, outputname, len(phylogeny.getLabelList()))
     
 
 
 class PhylogenyMapper:
-    def __init__(self, level, sibling_mapper, mlb, outputname):
+    def __init__(self, level, sibling_mapper, mlb, outputname, n_species):
         self.level = level
         
         self.sibling_mapper = sibling_mapper
@@ -32,27 +37,75 @@ class PhylogenyMapper:
         
         self.outputname = outputname
         
+        # lookup tables. Moved to the device of the truth on first use.
+        species_to_level = torch.LongTensor(list(map(lambda x: self.mlb.index(self.sibling_mapper(x, self.outputname)[0]), range(n_species))))
+        level_to_species = torch.LongTensor(self.mlb)
+        self.tables = {
+            'species_to_level': species_to_level,
+            'level_to_species': level_to_species,
+            'species_to_representative': level_to_species[species_to_level],
+        }
+        
     def get_len(self):
         return len(self.mlb)
     
+    # truth: indices of any shape -> table entries of the same shape, on the truth's device
+    def gather(self, table_name, truth):
+        truth = torch.as_tensor(truth)
+        if self.tables[table_name].device != truth.device:
+            self.tables = {name: table.to(truth.device) for name, table in self.tables.items()}
+        return self.tables[table_name][truth.long()]
+    
     # maps from fresh level indexing to species indexing
     def get_reverse_indexing(self, truth):
-        return list(map(lambda x: self.mlb[x], truth))
+        return self.gather('level_to_species', truth)
     
     # maps from species indexing to level indexing by species indexing convention
     def get_original_indexing_truth(self, truth):
-        return list(map(lambda x: self.sibling_mapper(x, self.outputname)[0], truth))
+        return self.gather('species_to_representative', truth)
     
     # maps from species indexing to fresh level indexing
     def get_mapped_truth(self, truth):
-        sibling_truth = self.get_original_indexing_truth(truth)
-        return torch.LongTensor(list(map(lambda x: self.mlb.index(x), sibling_truth))).to(truth.device)
+        return self.gather('species_to_level', truth)
 
 
 ######### Histogram misc
 
+# Jensen-Shannon distance along the last dimension, same as scipy's jensenshannon.
+# A, B: (..., n_embed) counts or unnormalized histograms. Broadcasts over the leading dimensions.
 def js_divergence(A, B):
-    return js_distance.jensenshannon(A,B)
+    p = get_count_frequencies(A)
+    q = get_count_frequencies(B)
+    log_m = torch.log(torch.clamp((p + q)/2, min=EPS))
+    rel_entr_p = torch.where(p > 0, p*(torch.log(torch.clamp(p, min=EPS)) - log_m), torch.zeros_like(p))
+    rel_entr_q = torch.where(q > 0, q*(torch.log(torch.clamp(q, min=EPS)) - log_m), torch.zeros_like(q))
+    js = (rel_entr_p + rel_entr_q).sum(dim=-1)/2
+    return torch.sqrt(torch.clamp(js, min=0))
+
+# (..., locations, n_embed) counts -> (..., locations) distances and most common codes of each side.
+def get_js_distances(counts1, counts2):
+    return js_divergence(counts1, counts2), get_count_modes(counts1), get_count_modes(counts2)
+
+def _get_js_distances_block(counts, block):
+    start, end = block
+    return js_divergence(counts[start:end, None], counts[None, :])
+
+# counts: (species, locations, n_embed) -> (species, species, locations) distances of all species pairs.
+# Rows are processed in blocks of block_size species to cap memory. On CPU, num_workers > 0 spreads the blocks over a process pool.
+def get_all_pairs_js_distances(counts, block_size=8, num_workers=0):
+    n = counts.shape[0]
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+    if num_workers > 0 and counts.device.type == 'cpu':
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=torch.set_num_threads, initargs=(1,)) as executor:
+            distances = list(executor.map(_get_js_distances_block, [counts]*len(blocks), blocks))
+    else:
+        distances = [_get_js_distances_block(counts, block) for block in blocks]
+    return torch.cat(distances, dim=0)
+
+# distances: (..., locations). masks: (levels, locations) bool -> (..., levels) mean distance over each mask's locations.
+def reduce_distances_by_masks(distances, masks):
+    masks = masks.to(distances)
+    return torch.matmul(distances, masks.t())/masks.sum(dim=1)
 
 
 class HistogramParser:
@@ -62,71 +115,270 @@ class HistogramParser:
         self.codes_per_phylolevel = model.phylo_disentangler.codes_per_phylolevel
         self.n_levels_non_attribute = model.phylo_disentangler.n_levels_non_attribute
     
+    # species1 and species2 can be indices or index tensors of the same shape.
     def get_distances(self, hist, species1, species2):
-        hist_species1 = hist[species1]
-        hist_species2 = hist[species2]
-        
-        distances = []
-        most_common1 = []
-        most_common2 = []
-        
-        for location_code in range(len(hist_species1)):
-            hist_species1_location = hist_species1[location_code]
-            hist_species2_location = hist_species2[location_code]
-            
-            hist_species1_location_histogram = torch.histc(torch.Tensor(hist_species1_location), bins=self.possible_codes, min=0, max=self.possible_codes-1)
-            hist_species1_location_histogram = hist_species1_location_histogram/torch.sum(hist_species1_location_histogram)
-            most_common1.append(torch.argmax(hist_species1_location_histogram))
-            
-            hist_species2_location_histogram = torch.histc(torch.Tensor(hist_species2_location), bins=self.possible_codes, min=0, max=self.possible_codes-1)
-            hist_species2_location_histogram = hist_species2_location_histogram/torch.sum(hist_species2_location_histogram)
-            most_common2.append(torch.argmax(hist_species2_location_histogram))
-        
-        
-            d = js_divergence(hist_species1_location_histogram, hist_species2_location_histogram)
-            distances.append(d)
-    
-        distances = torch.tensor(distances)
-        most_common1 = torch.tensor(most_common1)
-        most_common2 = torch.tensor(most_common2)
-        
-        return distances, most_common1, most_common2
+        return get_js_distances(hist[species1], hist[species2])
 
 
 ######## Histogram freq construction
 
+# counts: (classes, locations, n_embed). labels: (n,). codes: (n, locations)
+# Adds every (specimen, location) code of the batch to the counts in place.
+def add_code_counts(counts, labels, codes):
+    n_locations, n_embed = counts.shape[1], counts.shape[2]
+    labels = torch.as_tensor(labels).reshape(-1).to(counts.device).long()
+    codes = codes.reshape(labels.shape[0], n_locations).to(counts.device).long()
+    locations = torch.arange(n_locations, device=counts.device)
+    flat_index = (labels[:, None]*n_locations + locations[None, :])*n_embed + codes
+    counts.view(-1).scatter_add_(0, flat_index.reshape(-1), torch.ones(flat_index.numel(), dtype=counts.dtype, device=counts.device))
+    return counts
+
+# [classes][locations][raw list of codes] -> (classes, locations, n_embed)
+def code_lists_to_counts(hist_arr, n_embed):
+    counts = torch.zeros((len(hist_arr), len(hist_arr[0]), n_embed), dtype=torch.int32)
+    for class_indx, class_arr in enumerate(hist_arr):
+        for location, codes in enumerate(class_arr):
+            if len(codes) > 0:
+                counts[class_indx, location] = torch.bincount(torch.LongTensor(codes), minlength=n_embed).int()
+    return counts
+
+# (..., n_embed) counts -> (..., n_embed) frequencies
+def get_count_frequencies(counts):
+    counts = counts.float()
+    return counts/torch.clamp(counts.sum(dim=-1, keepdim=True), min=EPS)
+
+# (..., n_embed) counts -> (...) most common code
+def get_count_modes(counts):
+    return torch.argmax(counts, dim=-1)
+
+# (..., n_embed) counts -> (...) entropy in nats. Empty histograms have 0 entropy.
+def get_count_entropies(counts):
+    frequencies = get_count_frequencies(counts)
+    return -torch.sum(frequencies*torch.log(torch.clamp(frequencies, min=EPS)), dim=-1)
+
+# species_groups: lists of species names, e.g. from Phylogeny.get_species_groups -> (groups, species) 0/1 membership matrix
+def get_group_membership(species_groups, labels_to_idx, n_species):
+    membership = torch.zeros((len(species_groups), n_species), dtype=torch.int32)
+    for group_indx, species_group in enumerate(species_groups):
+        membership[group_indx, [labels_to_idx[species] for species in species_group]] = 1
+    return membership
+
+# membership: (groups, species). counts: (species, locations, n_embed) -> (groups, locations, n_embed)
+def get_group_counts(membership, counts):
+    return torch.tensordot(membership.to(counts.dtype), counts, dims=1)
+
+######## Histogram store
+# A store is a directory holding one .npy count array per branch and a JSON metadata file:
+#   metadata.json: version, ckpt_hash, labels, n_embed, layout (shape of each count array)
+#   attribute.npy, non_attribute.npy: int32 (classes, locations, n_embed) counts
+# Counts of shards computed on different data subsets add up, so shards are merged by summing.
+
+HISTOGRAMS_METADATA_FILE = "metadata.json"
+HISTOGRAMS_ARRAY_FILES = {False: "attribute.npy", True: "non_attribute.npy"}
+
+# sha256 of the checkpoint file. Identifies which model the histograms were computed with.
+# Cached next to the checkpoint, keyed by its size and mtime, so a checkpoint is hashed once.
+def get_ckpt_hash(ckpt_path, chunk_size=1<<24):
+    stat = os.stat(ckpt_path)
+    file_key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    hash_cache_path = ckpt_path + ".sha256.json"
+    if os.path.exists(hash_cache_path):
+        with open(hash_cache_path, "r") as f:
+            hash_cache = json.load(f)
+        if hash_cache.get('file') == file_key:
+            return hash_cache['sha256']
+
+    sha = hashlib.sha256()
+    with open(ckpt_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    try:
+        with open(hash_cache_path, "w") as f:
+            json.dump({'file': file_key, 'sha256': sha.hexdigest()}, f)
+    except OSError: # read-only checkpoint folder
+        pass
+    return sha.hexdigest()
+
+# sha256 of count arrays. Identifies the counts that derived tables (e.g. group counts) were computed from.
+def get_counts_hash(*counts_arrs):
+    sha = hashlib.sha256()
+    for counts in counts_arrs:
+        if counts is not None:
+            sha.update(counts.cpu().numpy().astype(np.int32).tobytes())
+    return sha.hexdigest()
+
+# The store a run writes to. histograms_path is an optional store or legacy pickle path from the config.
+# A legacy pickle gets a store next to it.
+def get_histograms_store_path(histograms_folder, histograms_path=None):
+    if histograms_path is None:
+        return os.path.join(histograms_folder, CONSTANTS.HISTOGRAMS_STORE)
+    if os.path.isfile(histograms_path):
+        return os.path.splitext(histograms_path)[0] + "_store"
+    return histograms_path
+
+# Returns the histogram store of a histograms folder, or the legacy pickle if only that exists.
+def get_histograms_path(histograms_folder):
+    store_path = os.path.join(histograms_folder, CONSTANTS.HISTOGRAMS_STORE)
+    legacy_path = os.path.join(histograms_folder, CONSTANTS.HISTOGRAMS_FILE)
+    if not os.path.exists(store_path) and os.path.exists(legacy_path):
+        return legacy_path
+    return store_path
+
+def load_histograms_metadata(store_path):
+    with open(os.path.join(store_path, HISTOGRAMS_METADATA_FILE), "r") as f:
+        metadata = json.load(f)
+    assert metadata['version'] <= CONSTANTS.HISTOGRAMS_STORE_VERSION, "Histogram store version " + str(metadata['version']) + " is not supported."
+    return metadata
+
+def save_histograms(store_path, hist_arr, hist_arr_nonattr=None, metadata=None):
+    os.makedirs(store_path, exist_ok=True)
+    metadata = {**(metadata if metadata is not None else {}),
+        'version': CONSTANTS.HISTOGRAMS_STORE_VERSION,
+        'n_embed': hist_arr.shape[-1],
+        'layout': {
+            'attribute': list(hist_arr.shape),
+            'non_attribute': list(hist_arr_nonattr.shape) if hist_arr_nonattr is not None else None,
+        },
+        'dtype': 'int32',
+    }
+    for is_nonattribute, counts in [(False, hist_arr), (True, hist_arr_nonattr)]:
+        if counts is not None:
+            np.save(os.path.join(store_path, HISTOGRAMS_ARRAY_FILES[is_nonattribute]), counts.cpu().numpy().astype(np.int32))
+    with open(os.path.join(store_path, HISTOGRAMS_METADATA_FILE), "w") as f:
+        json.dump(metadata, f)
+
+# Returns (hist_arr, hist_arr_nonattr) as count tensors.
+# classes: optional list of class indices. Only those rows are read from the memory-mapped arrays.
+# Also reads the legacy pickle of raw code lists.
+def load_histograms(file_path, n_embed, classes=None):
+    if os.path.isdir(file_path):
+        metadata = load_histograms_metadata(file_path)
+        assert metadata['n_embed'] == n_embed, "Histograms were built for a codebook of size " + str(metadata['n_embed'])
+        hists = []
+        for is_nonattribute in [False, True]:
+            counts = None
+            if metadata['layout']['non_attribute' if is_nonattribute else 'attribute'] is not None:
+                counts = np.load(os.path.join(file_path, HISTOGRAMS_ARRAY_FILES[is_nonattribute]), mmap_mode='r')
+                counts = torch.from_numpy(np.array(counts if classes is None else counts[classes]))
+            hists.append(counts)
+        return hists[0], hists[1]
+
+    hist_arr, hist_arr_nonattr = pickle.load(open(file_path, "rb"))
+    if not isinstance(hist_arr, torch.Tensor):
+        hist_arr = code_lists_to_counts(hist_arr, n_embed)
+        if hist_arr_nonattr is not None:
+            hist_arr_nonattr = code_lists_to_counts(hist_arr_nonattr, n_embed)
+    if classes is not None:
+        hist_arr = hist_arr[classes]
+        hist_arr_nonattr = hist_arr_nonattr[classes] if hist_arr_nonattr is not None else None
+    return hist_arr, hist_arr_nonattr
+
+# Sums the counts of histogram stores computed with the same model and labels on different data.
+def merge_histograms(store_paths, output_path):
+    metadata = None
+    hist_arr, hist_arr_nonattr = None, None
+    for store_path in store_paths:
+        shard_metadata = load_histograms_metadata(store_path)
+        if metadata is None:
+            metadata = shard_metadata
+        for key in ['ckpt_hash', 'labels', 'n_embed', 'layout']:
+            assert shard_metadata.get(key) == metadata.get(key), store_path + " has a different " + key + " than " + store_paths[0]
+        
+        shard_arr, shard_arr_nonattr = load_histograms(store_path, metadata['n_embed'])
+        hist_arr = shard_arr if hist_arr is None else hist_arr + shard_arr
+        if shard_arr_nonattr is not None:
+            hist_arr_nonattr = shard_arr_nonattr if hist_arr_nonattr is None else hist_arr_nonattr + shard_arr_nonattr
+    
+    save_histograms(output_path, hist_arr, hist_arr_nonattr, metadata)
+    print(output_path, 'merged from', store_paths)
+    return hist_arr, hist_arr_nonattr
+
+
+######## Entropy tables
+# Per-class location entropies and code orderings, computed once from the counts and kept in the histogram store.
+ENTROPY_TABLES_FOLDER = "entropy_tables"
+ENTROPY_TABLES = ['entropies', 'entropies_nonattr', 'orderings']
+
+# entropies: (classes, locations) -> (classes, locations) location indices from highest to lowest entropy
+def get_entropy_orderings(entropies):
+    return np.flip(np.argsort(entropies, axis=-1), axis=-1)
+
+# Order in which specimen translation replaces codes: the non-attribute codes, then the phylo codes level by level.
+# Within each, from highest to lowest entropy.
+# -> (classes, nonattr locations + phylo locations) indices into the concatenated [phylo, nonattr] code.
+def get_translation_orderings(entropies, entropies_nonattr, n_phylolevels):
+    n_classes, n_phylocodes = entropies.shape
+    level_entropies = entropies.reshape(n_classes, -1, n_phylolevels) # location i is at [i//n_phylolevels, i%n_phylolevels]
+    phylo_orderings = [get_entropy_orderings(level_entropies[:, :, lvl])*n_phylolevels + lvl for lvl in range(n_phylolevels)]
+    nonattr_ordering = get_entropy_orderings(entropies_nonattr) + n_phylocodes
+    return np.concatenate([nonattr_ordering] + phylo_orderings, axis=1)
+
+# Returns {table name: (classes, ...) array}. Tables are recomputed when the histogram store is newer than them.
+# A legacy pickle has no store to keep them in, so they are only computed.
+def get_entropy_tables(file_path, n_embed, n_phylolevels):
+    tables_path = os.path.join(file_path, ENTROPY_TABLES_FOLDER)
+    table_files = {name: os.path.join(tables_path, name+".npy") for name in ENTROPY_TABLES}
+    if os.path.isdir(file_path):
+        store_time = os.path.getmtime(os.path.join(file_path, HISTOGRAMS_METADATA_FILE))
+        if all(os.path.exists(f) and os.path.getmtime(f) >= store_time for f in table_files.values()):
+            return {name: np.load(f, mmap_mode='r') for name, f in table_files.items()}
+    
+    hist_arr, hist_arr_nonattr = load_histograms(file_path, n_embed)
+    entropies = get_count_entropies(hist_arr).cpu().numpy()
+    entropies_nonattr = get_count_entropies(hist_arr_nonattr).cpu().numpy()
+    tables = {
+        'entropies': entropies,
+        'entropies_nonattr': entropies_nonattr,
+        'orderings': get_translation_orderings(entropies, entropies_nonattr, n_phylolevels),
+    }
+    
+    if os.path.isdir(file_path):
+        os.makedirs(tables_path, exist_ok=True)
+        for name, f in table_files.items():
+            np.save(f, tables[name])
+    return tables
+
+
+# indexing of hist_arr: [class][code_location][code] -> count
 class HistogramFrequency:
-    def __init__(self, num_of_classes, num_of_locations, num_of_locations_nonattr=None):
-        self.hist_arr = [[] for x in range(num_of_classes)]
-        for i in range(len(self.hist_arr)):
-            self.hist_arr[i] = [[] for x in range(num_of_locations)]
+    # metadata: saved alongside the counts, e.g. {'ckpt_hash': ..., 'labels': [...]}
+    def __init__(self, num_of_classes, num_of_locations, n_embed, num_of_locations_nonattr=None, metadata=None):
+        self.n_embed = n_embed
+        self.metadata = dict(metadata) if metadata is not None else {}
+        self.hist_arr = torch.zeros((num_of_classes, num_of_locations, n_embed), dtype=torch.int32)
         
         self.hist_arr_nonattr = None 
         if num_of_locations_nonattr is not None:
-            self.hist_arr_nonattr = [[] for x in range(num_of_classes)]
-            for i in range(len(self.hist_arr)):
-                self.hist_arr_nonattr[i] = [[] for x in range(num_of_locations_nonattr)]
+            self.hist_arr_nonattr = torch.zeros((num_of_classes, num_of_locations_nonattr, n_embed), dtype=torch.int32)
             
     def load_from_file(self, file_path):
-        temp = pickle.load(open(file_path, "rb"))
-        self.hist_arr=temp[0]
-        self.hist_arr_nonattr=temp[1]
+        self.hist_arr, self.hist_arr_nonattr = load_histograms(file_path, self.n_embed)
+        if os.path.isdir(file_path):
+            self.metadata = load_histograms_metadata(file_path)
         print(file_path, 'loaded!')
         
     def save_to_file(self, file_path):
-        pickle.dump((self.hist_arr, self.hist_arr_nonattr), open(file_path, "wb"))
+        save_histograms(file_path, self.hist_arr, self.hist_arr_nonattr, self.metadata)
         print(file_path, 'saved!')
     
-    def set_location_frequencies(self, lbl,output_indices, output_indices_nonattr=None):
-        # iterate through code locations
-        for code_location in range(output_indices.shape[1]):
-            code = output_indices[0, code_location]
-            self.hist_arr[lbl][code_location].append(code.item()) 
+    # lbl: (n,) class indices. output_indices: (n, locations) codes.
+    def set_location_frequencies(self, lbl, output_indices, output_indices_nonattr=None):
+        add_code_counts(self.hist_arr, lbl, output_indices)
             
         if self.hist_arr_nonattr is not None:
-            for code_location in range(output_indices_nonattr.shape[1]):
-                code = output_indices_nonattr[0, code_location]
-                self.hist_arr_nonattr[lbl][code_location].append(code.item()) 
+            add_code_counts(self.hist_arr_nonattr, lbl, output_indices_nonattr)
+
+    def get_counts(self, is_nonattribute=False):
+        return self.hist_arr if not is_nonattribute else self.hist_arr_nonattr
+
+    def get_frequencies(self, is_nonattribute=False):
+        return get_count_frequencies(self.get_counts(is_nonattribute))
+
+    def get_modes(self, is_nonattribute=False):
+        return get_count_modes(self.get_counts(is_nonattribute))
+
+    def get_entropies(self, is_nonattribute=False):
+        return get_count_entropies(self.get_counts(is_nonattribute))
 
 ######### Misc
 
@@ -171,9 +423,10 @@ def get_HammingDistance_matrix(features):
 
 
 class Embedding_Code_converter():
-    def __init__(self, get_codebook_entry_index_function, embedding_function, embedding_shape):
+    # get_codebook_entry_indices_function: batched codebook search, (n, e_dim) -> (indices, distances)
+    def __init__(self, get_codebook_entry_indices_function, embedding_function, embedding_shape):
         self.embedding_function = embedding_function
-        self.get_codebook_entry_index_function = get_codebook_entry_index_function
+        self.get_codebook_entry_indices_function = get_codebook_entry_indices_function
         self.embedding_shape = embedding_shape # (16, 8, 4))
 
     
@@ -198,6 +451,15 @@ class Embedding_Code_converter():
         sub_code_reshaped_back = self.reshape_code(sub_code_reshaped)
         return sub_code_reshaped_back
     
+    # (levels, 32) bool masks of the code locations kept by get_sub_level for each level
+    def get_sub_level_masks(self, n_levels):
+        n_locations = self.embedding_shape[-2]*self.embedding_shape[-1]
+        locations = torch.arange(n_locations).unsqueeze(0)
+        masks = torch.zeros((n_levels, n_locations), dtype=torch.bool)
+        for level in range(n_levels):
+            masks[level, self.get_sub_level(locations, level)[0]] = True
+        return masks
+
     def get_post_level(self, code, level):
         code_reshaped = self.reshape_code(code, reverse = True)
         sub_code_reshaped = code_reshaped[:,:,level:]
@@ -252,13 +514,14 @@ class Embedding_Code_converter():
         return ans
 
     # (n, 16, 8, 4) - > (n, 32)
-    def get_phylo_codes(self, z_phylo, verify=False):
-        embeddings = self.reshape_zphylo(z_phylo) 
+    # chunk_size bounds the number of (specimen, location) entries searched at once.
+    # exact looks quantized embeddings up directly, searching only the entries that are not codebook vectors.
+    def get_phylo_codes(self, z_phylo, verify=False, chunk_size=None, exact=True):
+        embeddings = self.reshape_zphylo(z_phylo)
+        entries = embeddings.reshape(-1, embeddings.shape[-1])
 
-        codes = torch.zeros((embeddings.shape[0], embeddings.shape[1])).to(z_phylo.device).long()
-        for i in range(embeddings.shape[0]):
-            for j in range(embeddings.shape[1]):
-                codes[i, j] = self.get_codebook_entry_index_function(embeddings[i, j, :].reshape(1, -1))[0]
+        codes, _ = self.get_codebook_entry_indices_function(entries, chunk=chunk_size, exact=exact)
+        codes = codes.reshape(embeddings.shape[0], embeddings.shape[1]).long()
 
         if verify:
             embeddings = self.get_phylo_embeddings(codes, verify=False)
@@ -266,13 +529,14 @@ class Embedding_Code_converter():
 
         return codes
 
+    # quantizer indices (n*8*4) -> (n, 32)
+    # The quantizer flattens its input as (b h w), which is the same location order as reshape_zphylo.
+    def get_phylo_codes_from_indices(self, min_encoding_indices, n):
+        return min_encoding_indices.reshape(n, -1).long()
+
     # (n, 16, 8, 4) < - (n, 32)
     def get_phylo_embeddings(self, phylo_code, verify=False):
-        embeddings = torch.zeros(self.embedding_shape).reshape(self.embedding_shape[0], -1).unsqueeze(0).repeat(phylo_code.shape[0], 1, 1).permute(0,2,1).to(phylo_code.device) # (n,32,16)
-        for i in range(embeddings.shape[0]):
-            for j in range(embeddings.shape[1]):
-                embeddings[i, j, :] = self.embedding_function(phylo_code[i, j])
-
+        embeddings = self.embedding_function(phylo_code.long()) # (n,32,16)
         embeddings = self.reshape_zphylo(embeddings, reverse=True)
 
         if verify:
@@ -3,11 +3,13 @@ DISENTANGLER_ENCODER_INPUT = 'in'
 QUANTIZED_PHYLO_OUTPUT = 'zq_phylo'
 DISENTANGLER_CLASS_OUTPUT = 'class'
 QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT = 'zq_phylo_nonattribute'
+QUANTIZED_PHYLO_CODES = 'zq_phylo_codes'
+QUANTIZED_PHYLO_NONATTRIBUTE_CODES = 'zq_phylo_nonattribute_codes'
 DISENTANGLER_NON_ATTRIBUTE_TO_ATTRIBUTE_OUTPUT = 'nonattribate_to_attribute'
 DISENTANGLER_NON_ATTRIBUTE_CLASS_OUTPUT = 'adversarial_classifier_output'
 DISENTANGLER_ADV_MAPPING_OUTPUT = 'adversarial_mapping_output'
 DISENTANGLER_ADV_LEARNING_OUTPUT = 'adversarial_learning_output'
-NON_CLASS_TENSORS = [DISENTANGLER_ADV_LEARNING_OUTPUT, DISENTANGLER_ADV_MAPPING_OUTPUT, DISENTANGLER_ENCODER_INPUT, DISENTANGLER_DECODER_OUTPUT, QUANTIZED_PHYLO_OUTPUT, DISENTANGLER_NON_ATTRIBUTE_TO_ATTRIBUTE_OUTPUT, QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT, DISENTANGLER_NON_ATTRIBUTE_CLASS_OUTPUT]
+NON_CLASS_TENSORS = [DISENTANGLER_ADV_LEARNING_OUTPUT, DISENTANGLER_ADV_MAPPING_OUTPUT, DISENTANGLER_ENCODER_INPUT, DISENTANGLER_DECODER_OUTPUT, QUANTIZED_PHYLO_OUTPUT, DISENTANGLER_NON_ATTRIBUTE_TO_ATTRIBUTE_OUTPUT, QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT, DISENTANGLER_NON_ATTRIBUTE_CLASS_OUTPUT, QUANTIZED_PHYLO_CODES, QUANTIZED_PHYLO_NONATTRIBUTE_CODES]
 
 CLASS_TENSORS = [DISENTANGLER_CLASS_OUTPUT]  
 
@@ -20,7 +22,9 @@ DISENTANGLERTYPE_KEY = 'disentangler_type'
 COMPLETE_CKPT_KEY = "posttraining_ckpt"
 
 HISTOGRAMS_FOLDER='code_histograms'
-HISTOGRAMS_FILE="histograms.pkl"
+HISTOGRAMS_FILE="histograms.pkl" # legacy format
+HISTOGRAMS_STORE="histograms"
+HISTOGRAMS_STORE_VERSION=1
 
 DISENTANGLER_PHYLO_LOSS="/disentangler_phylo_loss"
 TRANSFORMER_LOSS="/loss"
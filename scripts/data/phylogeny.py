@@ -1,65 +1,104 @@
 import os
+import numpy as np
 import pandas as pd
 import math
 import pickle
+import hashlib
+import glob
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
 # For phylogeny parsing
-# !pip install opentree
-from opentree import OT
+# !pip install opentree (only needed by OpenTreeResolver)
 # !pip install ete3
 from ete3 import Tree, PhyloTree
+from omegaconf import DictConfig
+
+from scripts.import_utils import instantiate_from_config
 
 # Constants
 Fix_Tree = True
 format_ = 1
+Cache_Version = 2
 
 class Phylogeny:
     # Phylogeny class for Fish dataset
     # If node_ids is None, it assumes that the tree already exists. Otherwise, you have to pass node_ids (i.e., list of species names).
-    def __init__(self, filePath, node_ids=None, verbose=False):
+    # use_cache: loads distances, ancestors and groups from a cache next to the tree, without parsing the tree.
+    # resolver: resolves names and the tree when they are not on disk yet. A resolver object or its config. Defaults to OpenTreeResolver.
+    # precompute_distances: fills the whole distance matrix at construction. Otherwise pairs are filled on first use (for trees with many leaves).
+    def __init__(self, filePath, node_ids=None, verbose=False, use_cache=True, resolver=None, precompute_distances=True):
         # filenames for phylo tree and cached mapping ottid-speciesname
         cleaned_fine_tree_fileName = "cleaned_metadata.tre"
         name_conversion_file = "name_conversion.pkl"
+        cache_file = "phylogeny_cache.pkl"
         self.ott_ids = []
         self.ott_id_dict = {}
         self.node_ids = node_ids
         self.treeFileNameAndPath = os.path.join(filePath, cleaned_fine_tree_fileName)
         self.conversionFileNameAndPath = os.path.join(filePath, name_conversion_file)
+        self.cacheFileNameAndPath = os.path.join(filePath, cache_file)
+        self.cacheDirectory = filePath
+        self._cache_key = None
+        self.use_cache = use_cache
+        self.precompute_distances = precompute_distances
         self.total_distance = -1 # -1 means we never calculated it before.
-
-        self.distance_matrix = {}
+        self._tree = None # parsed on first use
+        if resolver is None:
+            resolver = OpenTreeResolver()
+        elif isinstance(resolver, (dict, DictConfig)): # config. hasattr is always True on a DictConfig
+            resolver = instantiate_from_config(resolver)
+        self.resolver = resolver
+
+        self.distance_matrix = None # (species, species) float32 patristic distances. Rows follow getLabelList(). NaN = not computed yet
+        self.species_depths = None # (species,) distance from root
+        self.species_to_indx = {}
         self.species_groups_within_relative_distance = {}
+        self.species_group_of_within_relative_distance = {} # relative_distance -> {species: its group}
+        self.node_index = {} # node name -> node
+        self.node_depths = {} # node -> distance from root
+        self.ancestors = {} # node -> [(ancestor node, distance from node)] up to the root
+        self.species_ancestors = {} # ott_id -> [(ancestor name, distance from the species node)] up to the root
 
         self.get_ott_ids(node_ids, verbose=verbose)
-        self.get_tree(self.treeFileNameAndPath)
-        self.get_total_distance()
+        if self.node_ids is None:
+            self.node_ids = self.ott_id_dict.keys()
+        
+        if not self.load_cache():
+            self.get_total_distance()
+            self.init_distance_matrix()
+            self.save_cache()
+        elif self.precompute_distances and np.isnan(self.distance_matrix).any():
+            # the cache was written by a run that filled distances on demand
+            self.init_distance_matrix()
+            self.save_cache()
+    
+    @property
+    def tree(self):
+        if self._tree is None:
+            self.get_tree(self.treeFileNameAndPath)
+            self.init_node_index()
+        return self._tree
     
     # Given two species names, get the phylo distance between them
     def get_distance(self, species1, species2):
-        d= None
-        if self.distance_matrix[species1][species2] == -1:
-            if species1 == species2:
-                return 0
-
-            ott_id1 = 'ott' + str(self.ott_id_dict[species1])
-            ott_id2 = 'ott' + str(self.ott_id_dict[species2])
-            d = self.tree.get_distance(ott_id1, ott_id2)
-
-            self.distance_matrix[species1][species2] = d
-        else:
-            d = self.distance_matrix[species1][species2]
-
-        return d
+        return self.get_distances(self.species_to_indx[species1], self.species_to_indx[species2]).item()
+    
+    # Given arrays of species indices (as in getLabelList), get the phylo distances between them. Broadcasts like numpy.
+    def get_distances(self, species1_indx, species2_indx):
+        distances = self.distance_matrix[species1_indx, species2_indx]
+        if np.isnan(distances).any():
+            self.fill_distances(species1_indx, species2_indx)
+            distances = self.distance_matrix[species1_indx, species2_indx]
+        return distances
 
     # relative_distance = 0 => species node itself
     # relative_distance = 1 => all species 
     def get_siblings_by_name(self, species, relative_distance, verbose=False):        
         self.get_species_groups(relative_distance, verbose)
-        for species_group in self.species_groups_within_relative_distance[relative_distance]:
-            if species in species_group:
-                return species_group
+        species_group_of = self.species_group_of_within_relative_distance[relative_distance]
+        if species in species_group_of:
+            return species_group_of[species]
         
         raise species+" was not found in " + self.species_groups_within_relative_distance[relative_distance]
     
@@ -74,26 +113,37 @@ class Phylogeny:
         return self.tree.get_distance(parent1, parent2)
     
     def get_species_groups(self, relative_distance, verbose=False):
-        if relative_distance not in self.species_groups_within_relative_distance.keys():
-            groups = {}
-
-            for species in self.getLabelList():
-                parent_node = self.get_parent_by_name(species, relative_distance, verbose)
-                parent = parent_node.name
-                if parent not in groups.keys():
-                    groups[parent] = [species]
-                else:
-                    groups[parent].append(species)
+        return self.get_species_groups_for_distances([relative_distance], verbose)[0]
+    
+    # Groups for a list of relative distances. Each species' ancestor chain is built once and reused for all of them.
+    def get_species_groups_for_distances(self, relative_distances, verbose=False):
+        missing_distances = sorted(set(relative_distance for relative_distance in relative_distances if relative_distance not in self.species_groups_within_relative_distance.keys()))
+        if len(missing_distances) > 0:
+            groups_arr = [{} for relative_distance in missing_distances]
             
-            self.species_groups_within_relative_distance[relative_distance] = groups.values()
+            for species in self.getLabelList():
+                parents = self.get_parent_names_by_ottid('ott' + str(self.ott_id_dict[species]), missing_distances)
+                for groups, parent in zip(groups_arr, parents):
+                    if parent not in groups.keys():
+                        groups[parent] = [species]
+                    else:
+                        groups[parent].append(species)
             
-            if verbose:
-                print("At relative_distance", relative_distance, ", the groups are:", groups.values())
+            for relative_distance, groups in zip(missing_distances, groups_arr):
+                self.set_species_groups(relative_distance, list(groups.values()))
+                
+                if verbose:
+                    print("At relative_distance", relative_distance, ", the groups are:", groups.values())
+            self.save_cache(save_distances=False)
         
-        return self.species_groups_within_relative_distance[relative_distance]
+        return [self.species_groups_within_relative_distance[relative_distance] for relative_distance in relative_distances]
                 
             
 
+    def set_species_groups(self, relative_distance, groups):
+        self.species_groups_within_relative_distance[relative_distance] = groups
+        self.species_group_of_within_relative_distance[relative_distance] = {species: species_group for species_group in groups for species in species_group}
+
     def getLabelList(self):
         return list(self.node_ids)
 
@@ -101,44 +151,206 @@ class Phylogeny:
     # ------- privete functions
 
     def get_total_distance(self):
-        if self.node_ids is None:
-            self.node_ids = self.ott_id_dict.keys()
-
-        self.init_distance_matrix()
-
         # For one time, measure distance from all leaves down to root. They all should be equal.
         # Save the value and reuse it.
         
         if self.total_distance==-1:
             for leaf in self.tree.iter_leaves():
-                total_distance = self.tree.get_distance(leaf) # gets distance to rootprint
+                total_distance = self.get_ancestors(leaf)[-1][1] # gets distance to root
                 assert math.isclose(self.total_distance, total_distance) or self.total_distance==-1
                 self.total_distance = total_distance
 
         return self.total_distance
 
+    # distance(a, b) = depth(a) + depth(b) - 2*depth(lca(a, b)).
+    # A single bottom-up pass fills all pairs whose lca is the current node: pairs across its children's species.
     def init_distance_matrix(self):
-        for i in self.node_ids:
-            self.distance_matrix[i] = {}
-            for j in self.node_ids:
-                self.distance_matrix[i][j] = -1
+        label_list = self.getLabelList()
+        self.species_to_indx = {species: indx for indx, species in enumerate(label_list)}
+        ottid_to_indx = {'ott' + str(self.ott_id_dict[species]): indx for indx, species in enumerate(label_list)}
+
+        tree = self.tree
+        depths = self.node_depths
+        if not self.precompute_distances:
+            self.species_depths = np.array([depths[self.get_node_by_name(ott_id)] for ott_id in ottid_to_indx.keys()])
+            self.distance_matrix = np.full((len(label_list), len(label_list)), np.nan, dtype=np.float32)
+            np.fill_diagonal(self.distance_matrix, 0)
+            return
+
+        species_depths = np.zeros(len(label_list))
+        self.distance_matrix = np.zeros((len(label_list), len(label_list)), dtype=np.float32)
+        species_under_node = {}
+        for node in tree.traverse("postorder"):
+            groups = [species_under_node.pop(child) for child in node.children]
+            if node.name in ottid_to_indx:
+                species_depths[ottid_to_indx[node.name]] = depths[node]
+                groups.append(np.array([ottid_to_indx[node.name]]))
+            groups = [group for group in groups if len(group) > 0]
+
+            for i, group_i in enumerate(groups):
+                for group_j in groups[i+1:]:
+                    d = species_depths[group_i][:, None] + species_depths[group_j][None, :] - 2*depths[node]
+                    self.distance_matrix[np.ix_(group_i, group_j)] = d
+                    self.distance_matrix[np.ix_(group_j, group_i)] = d.T
+            species_under_node[node] = np.concatenate(groups) if len(groups) > 0 else np.array([], dtype=int)
+        self.species_depths = species_depths
+
+    # Fills the missing pairs of get_distances(species1_indx, species2_indx) through their lowest common ancestor.
+    # Uses the cached ancestor tables (no tree parsing), and writes the filled pairs back to the cache.
+    def fill_distances(self, species1_indx, species2_indx):
+        label_list = self.getLabelList()
+        species1_indx, species2_indx = np.broadcast_arrays(np.asarray(species1_indx), np.asarray(species2_indx))
+        missing = np.isnan(self.distance_matrix[species1_indx, species2_indx])
+        pairs = set(zip(species1_indx[missing].tolist(), species2_indx[missing].tolist()))
+        for indx1, indx2 in pairs:
+            # root first. The chains agree down to the lowest common ancestor.
+            ancestors1 = self.get_species_ancestors('ott' + str(self.ott_id_dict[label_list[indx1]]))[::-1]
+            ancestors2 = self.get_species_ancestors('ott' + str(self.ott_id_dict[label_list[indx2]]))[::-1]
+            lca = next((i for i, (ancestor1, ancestor2) in enumerate(zip(ancestors1, ancestors2)) if ancestor1[0] != ancestor2[0]), min(len(ancestors1), len(ancestors2))) - 1
+            d = ancestors1[lca][1] + ancestors2[lca][1]
+            self.distance_matrix[indx1, indx2] = d
+            self.distance_matrix[indx2, indx1] = d
+        self.write_distances(pairs)
                 
+    # One pass over the tree: name -> node, and the depth of every node from the root.
+    def init_node_index(self):
+        self.node_index = {}
+        self.node_depths = {}
+        for node in self._tree.traverse("levelorder"): # same first match as tree.search_nodes
+            self.node_index.setdefault(node.name, node)
+            self.node_depths[node] = self.node_depths[node.up] + node.dist if node.up is not None else 0.0
+        self.ancestors = {}
+    
+    def get_node_by_name(self, name):
+        tree = self.tree # parses the tree and builds the index on first use
+        return self.node_index[name]
+    
+    # The node and its ancestors up to the root, each with its distance from the node.
+    # Distances are accumulated bottom-up, the same way tree.get_distance does.
+    def get_ancestors(self, species_node):
+        if species_node not in self.ancestors:
+            node = species_node
+            distance = 0.0
+            ancestors = [(node, distance)]
+            while node.up is not None:
+                distance += node.dist
+                node = node.up
+                ancestors.append((node, distance))
+            self.ancestors[species_node] = ancestors
+        return self.ancestors[species_node]
+    
+    # Ancestor index table of a species: [(ancestor name, distance from the species node)] up to the root.
+    # Kept in the cache, so groups can be built without the tree.
+    def get_species_ancestors(self, ott_id):
+        if ott_id not in self.species_ancestors:
+            self.species_ancestors[ott_id] = [(node.name, distance) for node, distance in self.get_ancestors(self.get_node_by_name(ott_id))]
+        return self.species_ancestors[ott_id]
+    
     def get_parent_by_ottid(self, ott_id, relative_distance, verbose=False):
+        ancestors = self.get_ancestors(self.get_node_by_name(ott_id))
+        return self.get_first_ancestor_beyond(ancestors, relative_distance, verbose)
+    
+    def get_parent_names_by_ottid(self, ott_id, relative_distances, verbose=False):
+        ancestors = self.get_species_ancestors(ott_id)
+        return [self.get_first_ancestor_beyond(ancestors, relative_distance, verbose) for relative_distance in relative_distances]
+    
+    # ancestors: [(ancestor, distance)] from the species node up. Returns the first ancestor at or beyond relative_distance, or the root.
+    def get_first_ancestor_beyond(self, ancestors, relative_distance, verbose=False):
         abs_distance = relative_distance*self.total_distance
-        species_node = self.tree.search_nodes(name=ott_id)[0]
         if verbose:
             print('distance to ancestor: ', abs_distance, ". relaive distance: ", relative_distance)
-
-        # keep going up till distance exceeds abs_distance
-        distance = 0
-        parent = species_node
-        while distance < abs_distance:
-            if parent.up is None:
-                break
-            parent = parent.up
-            distance = self.tree.get_distance(parent, species_node)
         
-        return parent
+        # keep going up till distance exceeds abs_distance
+        return next((ancestor for ancestor, distance in ancestors if not distance < abs_distance), ancestors[-1][0])
+
+    # ------- cache
+    # Keyed by the tree file and the species list, so the cache is rebuilt when either changes.
+    def get_cache_key(self):
+        if self._cache_key is None:
+            key = hashlib.sha256()
+            with open(self.treeFileNameAndPath, 'rb') as f:
+                key.update(f.read())
+            key.update(repr([(species, self.ott_id_dict[species]) for species in self.getLabelList()]).encode())
+            key.update(str(Cache_Version).encode())
+            self._cache_key = key.hexdigest()
+        return self._cache_key
+
+    # The distance matrix file carries the cache key in its name, so it is never paired with another key's cache.
+    def get_distances_path(self, key=None):
+        return os.path.join(self.cacheDirectory, "phylogeny_distances_{}.npy".format(key if key is not None else self.get_cache_key()))
+
+    def load_cache(self):
+        if not self.use_cache or not os.path.exists(self.cacheFileNameAndPath) or not os.path.exists(self.treeFileNameAndPath):
+            return False
+        with open(self.cacheFileNameAndPath, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['key'] != self.get_cache_key():
+            return False
+
+        if not os.path.exists(self.get_distances_path()):
+            return False
+        distance_matrix = np.load(self.get_distances_path())
+        if distance_matrix.shape != (len(self.getLabelList()), len(self.getLabelList())):
+            return False
+
+        self.total_distance = cache['total_distance']
+        self.distance_matrix = distance_matrix
+        self.species_depths = cache['species_depths']
+        self.species_ancestors = cache['species_ancestors']
+        self.species_to_indx = {species: indx for indx, species in enumerate(self.getLabelList())}
+        for relative_distance, groups in cache['species_groups'].items():
+            self.set_species_groups(relative_distance, groups)
+        return True
+
+    # The distance matrix is kept in its own .npy file (get_distances_path), so saving groups does not rewrite it
+    # and filled pairs can be written in place (write_distances). Matrices of other keys are removed.
+    def save_cache(self, save_distances=True):
+        if not self.use_cache:
+            return
+        for species in self.getLabelList():
+            self.get_species_ancestors('ott' + str(self.ott_id_dict[species]))
+        cache = {
+            'key': self.get_cache_key(),
+            'total_distance': self.total_distance,
+            'species_depths': self.species_depths,
+            'species_ancestors': self.species_ancestors,
+            'species_groups': self.species_groups_within_relative_distance,
+        }
+        # written aside and moved, so concurrent readers never see a partial file.
+        # A read-only data directory keeps the tables in memory only.
+        tmp_path = None
+        try:
+            distances_path = self.get_distances_path()
+            if save_distances or not os.path.exists(distances_path):
+                tmp_path = distances_path + '.' + str(os.getpid()) + '.npy'
+                np.save(tmp_path, self.distance_matrix)
+                os.replace(tmp_path, distances_path)
+                for stale_path in glob.glob(self.get_distances_path('*')):
+                    if stale_path != distances_path and len(stale_path) == len(distances_path): # not a temp file
+                        os.remove(stale_path)
+            tmp_path = self.cacheFileNameAndPath + '.' + str(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(cache, f)
+            os.replace(tmp_path, self.cacheFileNameAndPath)
+        except OSError as e:
+            print('Could not write the phylogeny cache. Using it in memory only.', e)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Writes the given (indx1, indx2) pairs of the distance matrix into the cached one of the same key in place.
+    def write_distances(self, pairs):
+        if not self.use_cache or len(pairs) == 0 or not os.path.exists(self.get_distances_path()):
+            return
+        try:
+            distance_matrix = np.load(self.get_distances_path(), mmap_mode='r+')
+        except OSError: # read-only cache
+            return
+        if distance_matrix.shape != self.distance_matrix.shape:
+            return
+        indx1, indx2 = np.array(list(pairs)).T
+        distance_matrix[indx1, indx2] = self.distance_matrix[indx1, indx2]
+        distance_matrix[indx2, indx1] = self.distance_matrix[indx2, indx1]
+        distance_matrix.flush()
 
 
 
@@ -151,32 +363,8 @@ class Phylogeny:
                 raise TypeError('No existing ottid-speciesnames found. node_ids should be a list of species names.')
             if verbose:
                 print('Included taxonomy: ', node_ids, len(node_ids))
-                df2 = pd.DataFrame(columns=['in csv', 'in response', 'Same?'])
-
-            # Get the matches
-            resp = OT.tnrs_match(node_ids, do_approximate_matching=True)
-            matches = resp.response_dict['results']
-            unmatched_names = resp.response_dict['unmatched_names']
-
-            # Get the corresponding ott_ids
-            ott_ids = set()
-            ott_id_dict={}
-            assert len(unmatched_names)==0 # everything is matched!
-            for match_array in matches:
-                match_array_matches = match_array['matches']
-                assert len(match_array_matches)==1, match_array['name'] + " has too many matches" + str(list(map(lambda x: x['matched_name'], match_array_matches)))  # we have a single unambiguous match!
-                first_match = match_array_matches[0]
-                ott_id = first_match['taxon']['ott_id']
-                ott_ids.add(ott_id)
-                if verbose:
-                    #some original and matched names are not exactly the same. Not a bug
-                    df2 = df2.append({'in csv':match_array['name'], 'in response': first_match['matched_name'], 'Same?': match_array['name'] == first_match['matched_name']}, ignore_index=True)
-                ott_id_dict[match_array['name']] = ott_id
-            ott_ids = list(ott_ids)
 
-            if verbose:
-                print(df2[df2['Same?']== False])
-                pp.pprint(ott_id_dict)
+            ott_ids, ott_id_dict = self.resolver.match_names(node_ids, verbose=verbose)
 
             with open(self.conversionFileNameAndPath, 'wb') as f:
                 pickle.dump([ott_ids, ott_id_dict], f)
@@ -189,6 +377,62 @@ class Phylogeny:
         self.ott_ids = ott_ids
         self.ott_id_dict = ott_id_dict
         print(self.ott_id_dict)
+    
+    def get_tree(self, treeFileNameAndPath):
+        if not os.path.exists(treeFileNameAndPath):
+            self.resolver.write_induced_tree(self.ott_ids, treeFileNameAndPath)
+
+        self._tree = PhyloTree(treeFileNameAndPath, format=format_)
+
+
+
+# ------- taxonomy resolvers
+# Used by Phylogeny when name_conversion.pkl or cleaned_metadata.tre are missing.
+#   match_names(node_ids, verbose) -> (ott_ids, {species name: ott_id}). Every name must match exactly one taxon.
+#   write_induced_tree(ott_ids, treeFileNameAndPath): writes the tree spanning ott_ids, with nodes named 'ott<id>'.
+
+class OpenTreeResolver:
+    # Live OpenTree API
+    def match_names(self, node_ids, verbose=False):
+        from opentree import OT
+        if verbose:
+            df2 = pd.DataFrame(columns=['in csv', 'in response', 'Same?'])
+
+        # Get the matches
+        resp = OT.tnrs_match(node_ids, do_approximate_matching=True)
+        matches = resp.response_dict['results']
+        unmatched_names = resp.response_dict['unmatched_names']
+
+        # Get the corresponding ott_ids
+        ott_ids = set()
+        ott_id_dict={}
+        assert len(unmatched_names)==0 # everything is matched!
+        for match_array in matches:
+            match_array_matches = match_array['matches']
+            assert len(match_array_matches)==1, match_array['name'] + " has too many matches" + str(list(map(lambda x: x['matched_name'], match_array_matches)))  # we have a single unambiguous match!
+            first_match = match_array_matches[0]
+            ott_id = first_match['taxon']['ott_id']
+            ott_ids.add(ott_id)
+            if verbose:
+                #some original and matched names are not exactly the same. Not a bug
+                df2 = df2.append({'in csv':match_array['name'], 'in response': first_match['matched_name'], 'Same?': match_array['name'] == first_match['matched_name']}, ignore_index=True)
+            ott_id_dict[match_array['name']] = ott_id
+        ott_ids = list(ott_ids)
+
+        if verbose:
+            print(df2[df2['Same?']== False])
+            pp.pprint(ott_id_dict)
+        
+        return ott_ids, ott_id_dict
+
+    def write_induced_tree(self, ott_ids, treeFileNameAndPath):
+        from opentree import OT
+        output = OT.synth_induced_tree(ott_ids=ott_ids, ignore_unknown_ids=False, label_format='id') # name_and_id ott_ids=list(ott_ids),
+
+        output.tree.write(path = treeFileNameAndPath, schema = "newick")
+
+        if Fix_Tree:
+            self.fix_tree(treeFileNameAndPath)
 
     def fix_tree(self, treeFileNameAndPath):
         tree = PhyloTree(treeFileNameAndPath, format=format_)
@@ -197,14 +441,57 @@ class Phylogeny:
         D = tree.search_nodes(name="mrcaott47023ott496121")[0]
         D.name = "ott496115"
         tree.write(format=format_, outfile=treeFileNameAndPath)
-    
-    def get_tree(self, treeFileNameAndPath):
-        if not os.path.exists(treeFileNameAndPath):
-            output = OT.synth_induced_tree(ott_ids=self.ott_ids, ignore_unknown_ids=False, label_format='id') # name_and_id ott_ids=list(ott_ids),
 
-            output.tree.write(path = treeFileNameAndPath, schema = "newick")
 
-            if Fix_Tree:
-                self.fix_tree(treeFileNameAndPath)
+class LocalTaxonomyResolver:
+    # Offline resolution, e.g. on clusters without network access.
+    # taxonomy_file: CSV or TSV (.tsv/.tab) table with name_column and ott_id_column.
+    # tree_file: Newick tree with nodes named 'ott<id>', e.g. a downloaded OpenTree synthetic tree.
+    def __init__(self, taxonomy_file, tree_file, name_column='name', ott_id_column='ott_id'):
+        self.taxonomy_file = taxonomy_file
+        self.tree_file = tree_file
+        self.name_column = name_column
+        self.ott_id_column = ott_id_column
+
+    # Case, underscores and repeated spaces are ignored when there is no exact match.
+    def normalize_name(self, name):
+        return " ".join(str(name).replace("_", " ").split()).lower()
+
+    def match_names(self, node_ids, verbose=False):
+        sep = '\t' if os.path.splitext(self.taxonomy_file)[1] in ['.tsv', '.tab'] else ','
+        table = pd.read_csv(self.taxonomy_file, sep=sep, usecols=[self.name_column, self.ott_id_column])
+        names = table[self.name_column].astype(str).tolist()
+        ids = table[self.ott_id_column].astype(int).tolist()
+        exact_matches = dict(zip(names, ids))
+        approximate_matches = {}
+        for name, ott_id in zip(names, ids):
+            approximate_matches.setdefault(self.normalize_name(name), set()).add(ott_id)
+
+        ott_id_dict = {}
+        unmatched_names = []
+        for name in node_ids:
+            if name in exact_matches:
+                ott_id_dict[name] = exact_matches[name]
+            else:
+                matches = approximate_matches.get(self.normalize_name(name), set())
+                assert len(matches) <= 1, name + " has too many matches" + str(matches) # we have a single unambiguous match!
+                if len(matches) == 0:
+                    unmatched_names.append(name)
+                else:
+                    ott_id_dict[name] = next(iter(matches))
+        assert len(unmatched_names)==0, "unmatched names: " + str(unmatched_names) # everything is matched!
+
+        if verbose:
+            pp.pprint(ott_id_dict)
+
+        return list(set(ott_id_dict.values())), ott_id_dict
+
+    def write_induced_tree(self, ott_ids, treeFileNameAndPath):
+        tree = PhyloTree(self.tree_file, format=format_)
+        names = set('ott' + str(ott_id) for ott_id in ott_ids)
+        nodes = [node for node in tree.traverse() if node.name in names]
+        found_names = set(node.name for node in nodes)
+        assert found_names == names, "not in " + self.tree_file + ": " + str(names - found_names)
 
-        self.tree = PhyloTree(treeFileNameAndPath, format=format_)
+        tree.prune(nodes, preserve_branch_length=True)
+        tree.write(format=format_, outfile=treeFileNameAndPath, dist_formatter="%0.17g") # merged branch lengths keep full precision
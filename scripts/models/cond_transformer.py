@@ -176,9 +176,8 @@ class Net2NetTransformer(pl.LightningModule):
 
     @torch.no_grad()
     def encode_to_z(self, x):
-        quant_z, _, info = self.first_stage_model.encode(x)
-        info = info[2]
-        indices = info.view(quant_z.shape[0], -1)
+        quant_z, indices = self.first_stage_model.encode_to_indices(x)
+        indices = indices.view(quant_z.shape[0], -1)
         indices = self.permuter(indices)
         return quant_z, indices
 
@@ -386,9 +385,7 @@ class PhyloNN_transformer(Net2NetTransformer):
                 
     @torch.no_grad()
     def encode_to_z(self, x):
-        zq_phylo, zq_nonphylo, _, _, _, _, info_attr, info_nonattr = self.first_stage_model.encode(x)
-        info_attr=info_attr[2]
-        info_nonattr=info_nonattr[2]
+        zq_phylo, zq_nonphylo, info_attr, info_nonattr = self.first_stage_model.encode_to_indices(x)
         quant_z = torch.cat((zq_phylo,zq_nonphylo), dim=3)
         indices_attr = info_attr.view(quant_z.shape[0], -1)
         indices_nonattr = info_nonattr.view(quant_z.shape[0], -1)
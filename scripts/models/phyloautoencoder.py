@@ -99,6 +99,25 @@ def create_phylo_classifier_layers(len_features, output_sizes, num_fc_layers, n_
 
     return torch.nn.ModuleDict(classification_layers)
 
+# Packs single-layer heads over the first k phylo levels into one block-structured linear layer over all levels.
+# Each head's weight is zero-padded over the levels it does not see, so the fused layer computes exactly the separate heads
+# and is built from their parameters (checkpoints stay the same).
+# input_shape: (embed_dim, codes_per_phylolevel, n_phylolevels). Returns weight, bias and the output size of each head.
+def fuse_phylo_classifier_layers(classification_layers, names, input_shape):
+    embed_dim, codes_per_phylolevel, n_phylolevels = input_shape
+    weights = []
+    biases = []
+    out_sizes = []
+    for name in names:
+        linear = classification_layers[name].seq[-1]
+        num_of_levels_included = int(linear.in_features/(embed_dim * codes_per_phylolevel))
+        weight = linear.weight.view(linear.out_features, embed_dim, codes_per_phylolevel, num_of_levels_included)
+        weight = torch.nn.functional.pad(weight, (0, n_phylolevels-num_of_levels_included))
+        weights.append(weight.reshape(linear.out_features, -1))
+        biases.append(linear.bias)
+        out_sizes.append(linear.out_features)
+    return torch.cat(weights), torch.cat(biases), out_sizes
+
 class PhyloDisentangler(torch.nn.Module):
     def __init__(self, 
                 in_channels, ch, out_ch, resolution, ## same ad ddconfigs for autoencoder
@@ -106,7 +125,10 @@ class PhyloDisentangler(torch.nn.Module):
                 n_phylo_channels, n_phylolevels, codes_per_phylolevel, # The dimensions for the phylo descriptors.
                 lossconfig, 
                 n_mlp_layers=1, n_levels_non_attribute=None,
-                lossconfig_phylo=None, lossconfig_kernelorthogonality=None, lossconfig_adversarial=None, verbose=False): 
+                lossconfig_phylo=None, lossconfig_kernelorthogonality=None, lossconfig_adversarial=None, verbose=False,
+                fused_classification_layers=False, # computes all single-layer phylo heads in one matmul
+                quantize_chunk_size=None, # latent vectors per nearest-code block in the quantizer. None = all at once
+                track_location_usage=False): # accumulates the code usage of each phylo location in training
         super().__init__()
 
         self.ch = ch
@@ -117,6 +139,8 @@ class PhyloDisentangler(torch.nn.Module):
         self.n_embed = n_embed
         self.n_levels_non_attribute = n_levels_non_attribute
         self.n_mlp_layers = n_mlp_layers
+        self.fused_classification_layers = fused_classification_layers
+        self.track_location_usage = track_location_usage
 
         self.verbose = verbose
 
@@ -146,9 +170,9 @@ class PhyloDisentangler(torch.nn.Module):
             
 
         # quantizer
-        self.quantize = VectorQuantizer(n_embed, embed_dim, beta=0.25)
+        self.quantize = VectorQuantizer(n_embed, embed_dim, beta=0.25, chunk_size=quantize_chunk_size)
 
-        self.embedding_converter = Embedding_Code_converter(self.quantize.get_codebook_entry_index, self.quantize.embedding, (self.embed_dim, self.codes_per_phylolevel, self.n_phylolevels))
+        self.embedding_converter = Embedding_Code_converter(self.quantize.get_codebook_entry_indices, self.quantize.embedding, (self.embed_dim, self.codes_per_phylolevel, self.n_phylolevels))
 
 
         # upsampling
@@ -183,6 +207,7 @@ class PhyloDisentangler(torch.nn.Module):
             # Create classification layers.
             num_fc_layers = self.loss_phylo.fc_layers
             self.classification_layers = create_phylo_classifier_layers(len_features, self.loss_phylo.classifier_output_sizes, num_fc_layers, n_phylolevels, self.loss_phylo.phylo_distances)
+            assert (not fused_classification_layers) or num_fc_layers==1, "Fused classification layers require fc_layers: 1."
 
             
         # Create adversarial loss
@@ -209,28 +234,42 @@ class PhyloDisentangler(torch.nn.Module):
         
         return outputs, {}
     
-    def encode(self, input, overriding_quant_attr=None, overriding_quant_nonattr=None):
+    # track_usage: records the codes of the phylo (attribute) branch in the quantizer's usage counts.
+    # The quantizer is shared with the non-attribute branch, whose codes are not recorded.
+    def encode(self, input, overriding_quant_attr=None, overriding_quant_nonattr=None, track_usage=False):
         h = self.conv_in(input)
 
         h_phylo, h_img = torch.split(h, [self.n_phylo_channels, self.ch - self.n_phylo_channels], dim=1)
         z_phylo = self.mlp_in(h_phylo)
-        zq_phylo, q_phylo_loss, info_attr = self.quantize(z_phylo)
+        zq_phylo, q_phylo_loss, info_attr = self.quantize(z_phylo, track_usage=track_usage)
+        codes_phylo = self.embedding_converter.get_phylo_codes_from_indices(info_attr[2], zq_phylo.shape[0])
+        if self.track_location_usage and track_usage:
+            self.quantize.record_location_usage(codes_phylo)
 
         if overriding_quant_attr is not None:
             assert zq_phylo.shape == overriding_quant_attr.shape, str(zq_phylo.shape) + "!=" + str(overriding_quant_attr.shape)
             zq_phylo = overriding_quant_attr
-        
-        
+            codes_phylo = self.embedding_converter.get_phylo_codes(zq_phylo)
+
+
         loss_dic = {'quantizer_loss': q_phylo_loss}
-        outputs = {CONSTANTS.QUANTIZED_PHYLO_OUTPUT: zq_phylo}
+        outputs = {
+            CONSTANTS.QUANTIZED_PHYLO_OUTPUT: zq_phylo,
+            CONSTANTS.QUANTIZED_PHYLO_CODES: codes_phylo,
+        }
 
         z_nonphylo = self.mlp_in_non_attribute(h_img)
         zq_nonphylo, q_nonphylo_loss, info_nonattr = self.quantize(z_nonphylo)
         if overriding_quant_nonattr is not None:
             assert z_nonphylo.shape == overriding_quant_nonattr.shape, str(z_nonphylo.shape) + "!=" + str(overriding_quant_nonattr.shape)
             z_nonphylo = overriding_quant_attr
-        
-        loss_dic = {'quantizer_loss': q_phylo_loss + q_nonphylo_loss}
+        outputs[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_CODES] = self.embedding_converter.get_phylo_codes_from_indices(info_nonattr[2], zq_nonphylo.shape[0])
+
+        loss_dic = {
+            'quantizer_loss': q_phylo_loss + q_nonphylo_loss,
+            'phylo_perplexity': info_attr[0],
+            'nonattr_perplexity': info_nonattr[0],
+        }
                 
         if self.loss_kernelorthogonality is not None:
             kernel_orthogonality_loss = 0
@@ -240,6 +279,14 @@ class PhyloDisentangler(torch.nn.Module):
                             
         return zq_phylo, zq_nonphylo, loss_dic, outputs, h_img, info_attr, info_nonattr
     
+    # Encode-only path: quantized phylo and non-attribute latents and their code indices, without losses or codes.
+    def encode_to_indices(self, input):
+        h = self.conv_in(input)
+        h_phylo, h_img = torch.split(h, [self.n_phylo_channels, self.ch - self.n_phylo_channels], dim=1)
+        zq_phylo, indices_attr = self.quantize.quantize_indices(self.mlp_in(h_phylo), return_zq=True)
+        zq_nonphylo, indices_nonattr = self.quantize.quantize_indices(self.mlp_in_non_attribute(h_img), return_zq=True)
+        return zq_phylo, zq_nonphylo, indices_attr, indices_nonattr
+
     def decode(self, zq_phylo, zq_nonphylo, loss_dic={}, outputs={}):
         hout_phylo = self.mlp_out(zq_phylo)
             
@@ -259,7 +306,12 @@ class PhyloDisentangler(torch.nn.Module):
             
 
         # Phylo networks
-        if self.loss_phylo is not None:
+        if self.loss_phylo is not None and self.fused_classification_layers:
+            names = list(self.classification_layers.keys())
+            weight, bias, out_sizes = fuse_phylo_classifier_layers(self.classification_layers, names, (self.embed_dim, self.codes_per_phylolevel, self.n_phylolevels))
+            fused_outputs = torch.nn.functional.linear(torch.flatten(zq_phylo, 1), weight, bias)
+            outputs.update(zip(names, torch.split(fused_outputs, out_sizes, dim=1)))
+        elif self.loss_phylo is not None:
             for name, layer in self.classification_layers.items():
                 num_of_levels_included = int(layer.get_inputsize()/(self.embed_dim * self.codes_per_phylolevel))
                 o = zq_phylo[:, :, :, :num_of_levels_included]
@@ -309,20 +361,24 @@ class PhyloVQVAE(VQModel):
         self.verbose = phylo_args.get('verbose', False)
         
     
-    def encode(self, x, overriding_quant=None, overriding_quant_nonattr=None):
+    def encode(self, x, overriding_quant=None, overriding_quant_nonattr=None, track_usage=False):
         encoder_out = self.encoder(x)
-        zq_phylo, zq_nonphylo, loss_dic, outputs, h_img, info_attr, info_nonattr = self.phylo_disentangler.encode(encoder_out, overriding_quant, overriding_quant_nonattr)
+        zq_phylo, zq_nonphylo, loss_dic, outputs, h_img, info_attr, info_nonattr = self.phylo_disentangler.encode(encoder_out, overriding_quant, overriding_quant_nonattr, track_usage=track_usage)
         return zq_phylo, zq_nonphylo, loss_dic, outputs, h_img, encoder_out, info_attr, info_nonattr
     
-    def decode(self, zq_phylo, zq_nonphylo, loss_dic={}, outputs={}, encoder_out=None):
+    # Encode-only path through the disentangler: (zq_phylo, zq_nonphylo, indices_attr, indices_nonattr).
+    def encode_to_indices(self, x):
+        return self.phylo_disentangler.encode_to_indices(self.encoder(x))
+
+    def decode(self, zq_phylo, zq_nonphylo, loss_dic={}, outputs={}, encoder_out=None, track_usage=False):
         disentangler_outputs, disentangler_loss_dic = self.phylo_disentangler.decode(zq_phylo, zq_nonphylo, loss_dic, outputs)
         
         disentangler_out = disentangler_outputs[CONSTANTS.DISENTANGLER_DECODER_OUTPUT]
         h = self.quant_conv(disentangler_out)
-        quant, base_quantizer_loss, _ = self.quantize(h)
+        quant, base_quantizer_loss, base_info = self.quantize(h, track_usage=track_usage)
 
         #consolidate dicts
-        base_loss_dic = {'quantizer_loss': base_quantizer_loss}
+        base_loss_dic = {'quantizer_loss': base_quantizer_loss, 'perplexity': base_info[0]}
         in_out_disentangler = {
             CONSTANTS.DISENTANGLER_ENCODER_INPUT: encoder_out,
         }
@@ -332,9 +388,10 @@ class PhyloVQVAE(VQModel):
         dec = self.decoder(quant)
         return dec, disentangler_loss_dic, base_loss_dic, in_out_disentangler
     
-    def forward(self, input, overriding_quant=None, overriding_quant_nonattr=None):
-        zq_phylo, zq_nonphylo, loss_dic, outputs, _, encoder_out, _, _ = self.encode(input, overriding_quant, overriding_quant_nonattr)
-        dec, disentangler_loss_dic, base_loss_dic, in_out_disentangler = self.decode(zq_phylo, zq_nonphylo, loss_dic, outputs, encoder_out)
+    # track_usage: records the codes in the usage counts of both quantizers. Enabled once per training step.
+    def forward(self, input, overriding_quant=None, overriding_quant_nonattr=None, track_usage=False):
+        zq_phylo, zq_nonphylo, loss_dic, outputs, _, encoder_out, _, _ = self.encode(input, overriding_quant, overriding_quant_nonattr, track_usage=track_usage)
+        dec, disentangler_loss_dic, base_loss_dic, in_out_disentangler = self.decode(zq_phylo, zq_nonphylo, loss_dic, outputs, encoder_out, track_usage=track_usage)
         return dec, disentangler_loss_dic, base_loss_dic, in_out_disentangler    
     
     #NOTE: This does not return losses. Only used for outputting!
@@ -349,7 +406,8 @@ class PhyloVQVAE(VQModel):
 
     def step(self, batch, batch_idx, optimizer_idx, prefix):        
         x = self.get_input(batch, self.image_key)
-        xrec, disentangler_loss_dic, base_loss_dic, in_out_disentangler = self(x)
+        # usage is recorded on training generator steps only. The adversarial step re-encodes the same batch.
+        xrec, disentangler_loss_dic, base_loss_dic, in_out_disentangler = self(x, track_usage=(optimizer_idx == 0 and self.training))
         out_class_disentangler = {i:in_out_disentangler[i] for i in in_out_disentangler if i not in CONSTANTS.NON_CLASS_TENSORS}
 
         if optimizer_idx==0 or (self.phylo_disentangler.loss_adversarial is None):
@@ -406,6 +464,17 @@ class PhyloVQVAE(VQModel):
             rec_loss = log_dict_ae[prefix+"/rec_loss"]
             losses[prefix+"/disentangler_quantizer_loss"] = quantizer_disentangler_loss
             losses[prefix+"/disentangler_rec_loss"] = rec_loss
+
+            # codebook usage. Perplexities are of this step's codes.
+            # The disentangler's usage counts (dead codes, codes per location) are of the phylo branch only.
+            losses[prefix+"/disentangler_phylo_perplexity"] = disentangler_loss_dic['phylo_perplexity']
+            losses[prefix+"/disentangler_nonattr_perplexity"] = disentangler_loss_dic['nonattr_perplexity']
+            losses[prefix+"/disentangler_phylo_dead_codes"] = self.phylo_disentangler.quantize.get_dead_codes().float()
+            losses[prefix+"/base_perplexity"] = base_loss_dic['perplexity']
+            losses[prefix+"/base_dead_codes"] = self.quantize.get_dead_codes().float()
+            if self.phylo_disentangler.quantize.location_usage is not None:
+                location_usage = self.phylo_disentangler.quantize.location_usage
+                losses[prefix+"/disentangler_phylo_codes_per_location"] = torch.sum(location_usage > 0, dim=1).float().mean()
             
             self.log_dict(losses, logger=True, on_step=False, on_epoch=True)
             
@@ -417,7 +486,9 @@ class PhyloVQVAE(VQModel):
                 'logs': losses
             }
             outputs[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT] = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT]
-            
+            outputs[CONSTANTS.QUANTIZED_PHYLO_CODES] = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_CODES]
+            outputs[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_CODES] = in_out_disentangler[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_CODES]
+
                 
             return outputs
         
@@ -441,6 +512,10 @@ class PhyloVQVAE(VQModel):
         self.log_dict(outputs['logs'], logger=True, on_step=False, on_epoch=True)
         return outputs['loss']
 
+    def on_train_epoch_start(self):
+        super().on_train_epoch_start()
+        self.phylo_disentangler.quantize.reset_usage()
+
     @torch.no_grad()
     def validation_step(self, batch, batch_idx):
         outputs = self.step(batch, batch_idx, optimizer_idx=0, prefix='val')
@@ -453,6 +528,8 @@ class PhyloVQVAE(VQModel):
         if CONSTANTS.QUANTIZED_PHYLO_OUTPUT in outputs[0]:
             self.validation_epoch_end_zq_phylos = torch.cat([x[CONSTANTS.QUANTIZED_PHYLO_OUTPUT] for x in outputs], 0)
             self.validation_epoch_end_zq_nonphylos = torch.cat([x[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_OUTPUT] for x in outputs], 0)
+            self.validation_epoch_end_zq_phylo_codes = torch.cat([x[CONSTANTS.QUANTIZED_PHYLO_CODES] for x in outputs], 0)
+            self.validation_epoch_end_zq_nonphylo_codes = torch.cat([x[CONSTANTS.QUANTIZED_PHYLO_NONATTRIBUTE_CODES] for x in outputs], 0)
             self.validation_epoch_end_classes = torch.cat([x[CONSTANTS.DISENTANGLER_CLASS_OUTPUT] for x in outputs], 0)
             self.validation_epoch_end_classnames = list(itertools.chain.from_iterable([x[CONSTANTS.DATASET_CLASSNAME] for x in outputs]))
     
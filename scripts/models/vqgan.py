@@ -25,6 +25,7 @@ class VQModel(pl.LightningModule):
                  monitor=None,
                  remap=None,
                  sane_index_shape=False,  # tell vector quantizer to return indices as bhw
+                 quantize_chunk_size=None, # latent vectors per nearest-code block in the quantizer. None = all at once
                  ):
         super().__init__()
         
@@ -41,7 +42,7 @@ class VQModel(pl.LightningModule):
         
         self.loss = instantiate_from_config(lossconfig)
         self.quantize = VectorQuantizer(n_embed, embed_dim, beta=0.25,
-                                        remap=remap, sane_index_shape=sane_index_shape)
+                                        remap=remap, sane_index_shape=sane_index_shape, chunk_size=quantize_chunk_size)
         self.quant_conv = torch.nn.Conv2d(ddconfig["z_channels"], embed_dim, 1)
         self.post_quant_conv = torch.nn.Conv2d(embed_dim, ddconfig["z_channels"], 1)
         if ckpt_path is not None:
@@ -65,12 +66,20 @@ class VQModel(pl.LightningModule):
         self.load_state_dict(sd, strict=False)
         print(f"Restored from {path}")
 
-    def encode(self, x):
+    # track_usage: records the codes in the quantizer's usage counts (once per training step).
+    def encode(self, x, track_usage=False):
         h = self.encoder(x)
         h = self.quant_conv(h)
-        quant, emb_loss, info = self.quantize(h)
+        quant, emb_loss, info = self.quantize(h, track_usage=track_usage)
         return quant, emb_loss, info
 
+    # Encode-only path: quantized latent and code indices, without the quantizer loss.
+    def encode_to_indices(self, x):
+        h = self.encoder(x)
+        h = self.quant_conv(h)
+        quant, indices = self.quantize.quantize_indices(h, return_zq=True)
+        return quant, indices
+
     def decode(self, quant):
         quant = self.post_quant_conv(quant)
         dec = self.decoder(quant)
@@ -82,8 +91,8 @@ class VQModel(pl.LightningModule):
         dec = self.decode(quant_b)
         return dec
 
-    def forward(self, input):
-        quant, diff, _ = self.encode(input)
+    def forward(self, input, track_usage=False):
+        quant, diff, _ = self.encode(input, track_usage=track_usage)
         dec = self.decode(quant)
         return dec, diff
 
@@ -96,7 +105,8 @@ class VQModel(pl.LightningModule):
 
     def training_step(self, batch, batch_idx, optimizer_idx):
         x = self.get_input(batch, self.image_key)
-        xrec, qloss = self(x)
+        # the discriminator step re-encodes the same batch, so usage is recorded on the generator step only.
+        xrec, qloss = self(x, track_usage=(optimizer_idx == 0))
 
         if optimizer_idx == 0 or (not self.loss.has_discriminator):
             # autoencode
@@ -104,6 +114,7 @@ class VQModel(pl.LightningModule):
                                             last_layer=self.get_last_layer(), split="train")
 
             log_dict_ae["train/aeloss"] = aeloss
+            log_dict_ae.update(self.quantize.get_usage_log("train/quantizer"))
             self.log_dict(log_dict_ae, prog_bar=False, logger=True, on_step=False, on_epoch=True)
             
             return aeloss
@@ -135,6 +146,9 @@ class VQModel(pl.LightningModule):
 
         return self.log_dict
 
+    def on_train_epoch_start(self):
+        self.quantize.reset_usage()
+
     @torch.no_grad()
     def on_validation_start(self):
         for v in self.trainer.val_dataloaders:
@@ -21,22 +21,36 @@ def get_loss_name(phylo_distances, level):
 
 class Species_sibling_finder():
     # Contructor
+    # Per loss name: group_ids[species_id] -> group id, and the species ids of each group as
+    # group_members[group_offsets[g]:group_offsets[g+1]], in label order.
     def __init__(self, phylogeny, genetic_distances_from_root):
-        self.map = {}
         self.phylogeny = phylogeny
-        for species in phylogeny.node_ids:
-            self.map[species] = {}
-            for indx, distance in enumerate(genetic_distances_from_root):
-                distance_relative = get_relative_distance_for_level(genetic_distances_from_root, indx)
-                self.map[species][get_loss_name(genetic_distances_from_root, indx)] = phylogeny.get_siblings_by_name(species, distance_relative)
+        self.group_ids = {}
+        self.group_members = {}
+        self.group_offsets = {}
+        
+        species_to_indx = {species: indx for indx, species in enumerate(phylogeny.getLabelList())}
+        species_groups_arr = phylogeny.get_species_groups_for_distances([get_relative_distance_for_level(genetic_distances_from_root, indx) for indx in range(len(genetic_distances_from_root))])
+        for indx, species_groups in enumerate(species_groups_arr):
+            loss_name = get_loss_name(genetic_distances_from_root, indx)
+            group_ids = np.zeros(len(species_to_indx), dtype=np.int64)
+            group_members = []
+            group_offsets = [0]
+            for group_id, species_group in enumerate(species_groups):
+                members = [species_to_indx[species] for species in species_group]
+                group_ids[members] = group_id
+                group_members.extend(members)
+                group_offsets.append(len(group_members))
+            
+            self.group_ids[loss_name] = group_ids
+            self.group_members[loss_name] = np.array(group_members, dtype=np.int64)
+            self.group_offsets[loss_name] = np.array(group_offsets, dtype=np.int64)
 
 
     def map_speciesId_siblingVector(self, speciesId, loss_name):
-        label_list = self.phylogeny.getLabelList()
-        species = label_list[speciesId]
-        siblings = self.map[species][loss_name]
-        siblings_indices = list(map(lambda x: label_list.index(x), siblings))
-        return siblings_indices
+        group_id = self.group_ids[loss_name][speciesId]
+        group_offsets = self.group_offsets[loss_name]
+        return self.group_members[loss_name][group_offsets[group_id]:group_offsets[group_id+1]]
     
 ###----------------------------------###
 
@@ -64,6 +78,12 @@ class PhyloLoss(nn.Module):
             species_groups_representatives = list(map(lambda x: x[0], species_groups))
             species_groups_representatives = list(map(lambda x: self.phylogeny.getLabelList().index(x), species_groups_representatives))
             self.mlb[get_loss_name(self.phylo_distances, level)] = species_groups_representatives
+        
+        # species_id -> ancestor class id of each level. Targets are then gathered on the device.
+        for level, i in enumerate(self.phylo_distances):
+            loss_name = get_loss_name(self.phylo_distances, level)
+            ancestor_classes = torch.from_numpy(self.siblingfinder.group_ids[loss_name]) # groups are ordered as in self.mlb
+            self.register_buffer(self.get_ancestor_classes_name(loss_name), ancestor_classes, persistent=False)
                 
 
         self.criterionCE = torch.nn.CrossEntropyLoss()
@@ -82,6 +102,9 @@ class PhyloLoss(nn.Module):
     def get_relative_distance_for_level(self, level):
         return get_relative_distance_for_level(self.phylo_distances, level)
     
+    def get_ancestor_classes_name(self, loss_name):
+        return "ancestor_classes_"+loss_name
+    
     def forward(self, cumulative_loss, activations, labels):
         losses_dict = {'individual_losses': {'class_loss': self.criterionCE(activations[CONSTANTS.DISENTANGLER_CLASS_OUTPUT], labels)}}
 
@@ -89,8 +112,7 @@ class PhyloLoss(nn.Module):
             if loss_name in CONSTANTS.CLASS_TENSORS:
                 continue
             
-            layer_truth = list(map(lambda x: self.siblingfinder.map_speciesId_siblingVector(x, loss_name), labels))
-            ancestor_truth = torch.LongTensor(list(map(lambda x: self.mlb[loss_name].index(x[0]), layer_truth))).to(activation.device)
+            ancestor_truth = getattr(self, self.get_ancestor_classes_name(loss_name)).index_select(0, labels)
             losses_dict['individual_losses'][loss_name+"_loss"] = self.criterionCE(activation, ancestor_truth)
 
 
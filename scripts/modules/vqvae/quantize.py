@@ -14,13 +14,18 @@ class VectorQuantizer2(nn.Module):
     # NOTE: due to a bug the beta term was applied to the wrong term. for
     # backwards compatibility we use the buggy version by default, but you can
     # specify legacy=False to fix it.
+    # chunk_size: number of latent vectors whose code distances are computed at once. None computes all of them together.
+    # usage_decay: decay of the EMA code usage counts collected in training.
+    # dead_code_threshold: codes whose EMA count is below this fraction of the mean count are dead.
     def __init__(self, n_e, e_dim, beta, remap=None, unknown_index="random",
-                 sane_index_shape=False, legacy=True):
+                 sane_index_shape=False, legacy=True, chunk_size=None,
+                 usage_decay=0.99, dead_code_threshold=0.01):
         super().__init__()
         self.n_e = n_e
         self.e_dim = e_dim
         self.beta = beta
         self.legacy = legacy
+        self.chunk_size = chunk_size
 
         self.embedding = nn.Embedding(self.n_e, self.e_dim)
         self.embedding.weight.data.uniform_(-1.0 / self.n_e, 1.0 / self.n_e)
@@ -35,52 +40,172 @@ class VectorQuantizer2(nn.Module):
                 self.re_embed = self.re_embed+1
             print(f"Remapping {self.n_e} indices to {self.re_embed} indices. "
                   f"Using {self.unknown_index} for unknown indices.")
+            self.build_remap_tables()
         else:
             self.re_embed = n_e
 
         self.sane_index_shape = sane_index_shape
 
+        # code usage telemetry. Reset with reset_usage.
+        self.usage_decay = usage_decay
+        self.dead_code_threshold = dead_code_threshold
+        self.register_buffer("usage_counts", torch.zeros(self.n_e), persistent=False)
+        self.register_buffer("usage_steps", torch.zeros((), dtype=torch.long), persistent=False)
+        self.register_buffer("step_perplexity", torch.zeros(()), persistent=False)
+        self.location_usage = None # (locations, n_e) counts, see record_location_usage
+
+    # Dense lookup tables for both remapping directions.
+    # remap_table (n_e,): position of each code in used (its first occurrence), unknown_index or -1 (random) if unused.
+    # unmap_table (re_embed,): code of each remapped index. The extra token maps to used[0].
+    def build_remap_tables(self):
+        used = self.used.cpu().long().numpy()
+        codes, first_positions = np.unique(used, return_index=True)
+        unknown = -1 if self.unknown_index == "random" else self.unknown_index
+        remap_table = torch.full((self.n_e,), unknown, dtype=torch.long)
+        remap_table[torch.from_numpy(codes)] = torch.from_numpy(first_positions)
+        unmap_table = torch.from_numpy(used)
+        if self.re_embed > unmap_table.shape[0]: # extra token
+            unmap_table = torch.cat([unmap_table, unmap_table[:1]])
+        self.register_buffer("remap_table", remap_table.to(self.used.device), persistent=False)
+        self.register_buffer("unmap_table", unmap_table.to(self.used.device), persistent=False)
+
+    # the tables are derived from used, so rebuild them once a checkpoint has loaded its own used.
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        if self.remap is not None:
+            self.build_remap_tables()
+
     def remap_to_used(self, inds):
         ishape = inds.shape
         assert len(ishape)>1
-        inds = inds.reshape(ishape[0],-1)
-        used = self.used.to(inds)
-        match = (inds[:,:,None]==used[None,None,...]).long()
-        new = match.argmax(-1)
-        unknown = match.sum(2)<1
+        new = self.remap_table.index_select(0, inds.reshape(-1).long())
         if self.unknown_index == "random":
+            unknown = new<0
             new[unknown]=torch.randint(0,self.re_embed,size=new[unknown].shape).to(device=new.device)
-        else:
-            new[unknown] = self.unknown_index
         return new.reshape(ishape)
 
     def unmap_to_all(self, inds):
         ishape = inds.shape
         assert len(ishape)>1
-        inds = inds.reshape(ishape[0],-1)
-        used = self.used.to(inds)
-        if self.re_embed > self.used.shape[0]: # extra token
-            inds[inds>=self.used.shape[0]] = 0 # simply set to zero
-        back=torch.gather(used[None,:][inds.shape[0]*[0],:], 1, inds)
+        back = self.unmap_table.index_select(0, inds.reshape(-1).long()).to(inds)
         return back.reshape(ishape)
 
-    def forward(self, z, temp=None, rescale_logits=False, return_logits=False):
+    # Nearest code of each row of z_flattened (n, e_dim). Rows are processed in blocks of chunk_size, so only
+    # a (chunk_size, n_e) block of distances exists at a time. Chunked and unchunked searches agree up to floating-point ties.
+    # return_distances also returns the squared distance of each row to its nearest code.
+    def get_nearest_indices(self, z_flattened, chunk_size=None, return_distances=False):
+        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
+        embedding_norms = torch.sum(self.embedding.weight**2, dim=1)
+        embedding_t = rearrange(self.embedding.weight, 'n d -> d n')
+        
+        chunk_size = chunk_size if chunk_size is not None else max(z_flattened.shape[0], 1)
+        min_encoding_indices = []
+        min_distances = []
+        for z_chunk in torch.split(z_flattened, chunk_size):
+            d = torch.sum(z_chunk ** 2, dim=1, keepdim=True) + \
+                embedding_norms - 2 * \
+                torch.einsum('bd,dn->bn', z_chunk, embedding_t)
+            min_encoding_indices.append(torch.argmin(d, dim=1))
+            if return_distances:
+                min_distances.append(d.gather(1, min_encoding_indices[-1].unsqueeze(1)).squeeze(1))
+        if return_distances:
+            return torch.cat(min_encoding_indices), torch.cat(min_distances)
+        return torch.cat(min_encoding_indices)
+
+    def reset_usage(self):
+        self.usage_counts.zero_()
+        self.usage_steps.zero_()
+        self.step_perplexity.zero_()
+        self.location_usage = None
+
+    # (n_e,) counts of the given codes. The output size is fixed, so unlike bincount it needs no host sync.
+    def get_code_counts(self, min_encoding_indices):
+        min_encoding_indices = min_encoding_indices.reshape(-1)
+        return torch.zeros(self.n_e, device=min_encoding_indices.device).scatter_add_(
+            0, min_encoding_indices, torch.ones(min_encoding_indices.shape, device=min_encoding_indices.device))
+
+    # perplexity of the code counts of one step. n_e for uniform usage, 1 for a collapsed codebook.
+    def get_perplexity(self, counts):
+        probs = counts/counts.sum().clamp(min=1)
+        return torch.exp(-torch.sum(probs*torch.log(probs + 1e-10)))
+
+    # Updates the EMA usage counts with the codes of one training step and returns its perplexity (see forward's track_usage).
+    # The first step after a reset initializes the counts. Everything stays on the device.
+    def record_usage(self, min_encoding_indices):
+        counts = self.get_code_counts(min_encoding_indices)
+        decay = self.usage_decay*(self.usage_steps > 0).float()
+        self.usage_counts.mul_(decay).add_((1 - decay)*counts)
+        self.usage_steps.add_(1)
+        self.step_perplexity.copy_(self.get_perplexity(counts))
+        return self.step_perplexity.clone()
+
+    # Accumulates per-location code counts. min_encoding_indices: (b, locations)
+    def record_location_usage(self, min_encoding_indices):
+        n_locations = min_encoding_indices.shape[1]
+        if self.location_usage is None:
+            self.location_usage = torch.zeros((n_locations, self.n_e), dtype=torch.long, device=min_encoding_indices.device)
+        locations = torch.arange(n_locations, device=min_encoding_indices.device).expand_as(min_encoding_indices)
+        flat_indices = (locations*self.n_e + min_encoding_indices).reshape(-1)
+        self.location_usage.view(-1).scatter_add_(0, flat_indices, torch.ones_like(flat_indices))
+
+    def get_dead_codes(self):
+        return torch.sum(self.usage_counts < self.dead_code_threshold*self.usage_counts.mean())
+
+    # step_perplexity is overwritten in place every step, so the logged value is a copy.
+    def get_usage_log(self, prefix):
+        return {
+            prefix+"/perplexity": self.step_perplexity.clone(),
+            prefix+"/dead_codes": self.get_dead_codes().float(),
+        }
+
+    # Remaps the flat indices of a (b, h, w) latent and reshapes them the way forward returns them.
+    def format_indices(self, min_encoding_indices, b, h, w):
+        if self.remap is not None:
+            min_encoding_indices = min_encoding_indices.reshape(b,-1) # add batch axis
+            min_encoding_indices = self.remap_to_used(min_encoding_indices)
+            min_encoding_indices = min_encoding_indices.reshape(-1,1) # flatten
+
+        if self.sane_index_shape:
+            min_encoding_indices = min_encoding_indices.reshape(b, h, w)
+        return min_encoding_indices
+
+    # Eval-only entry point. Returns the code indices (formatted as in forward) and, if return_zq, the
+    # quantized latent (b, c, h, w) before them. No loss, straight-through estimator or contiguous copies.
+    def quantize_indices(self, z, return_zq=False):
+        b, _, h, w = z.shape
+        z_flattened = z.permute(0, 2, 3, 1).reshape(-1, self.e_dim)
+        min_encoding_indices = self.get_nearest_indices(z_flattened, self.chunk_size)
+        indices = self.format_indices(min_encoding_indices, b, h, w)
+        if not return_zq:
+            return indices
+
+        z_q = self.embedding(min_encoding_indices).view(b, h, w, self.e_dim).permute(0, 3, 1, 2)
+        return z_q, indices
+
+    # track_usage: records the codes in the EMA usage counts. Callers enable it once per training step
+    # (e.g. on the generator step only), so each batch is counted once.
+    def forward(self, z, temp=None, rescale_logits=False, return_logits=False, track_usage=False):
         assert temp is None or temp==1.0, "Only for interface compatible with Gumbel"
         assert rescale_logits==False, "Only for interface compatible with Gumbel"
         assert return_logits==False, "Only for interface compatible with Gumbel"
+        min_encodings = None
+
+        # without gradients both loss terms have the same value and the straight-through estimator is a no-op.
+        if not torch.is_grad_enabled():
+            b, _, h, w = z.shape
+            min_encoding_indices = self.get_nearest_indices(z.permute(0, 2, 3, 1).reshape(-1, self.e_dim), self.chunk_size)
+            perplexity = self.record_usage(min_encoding_indices) if track_usage else self.get_perplexity(self.get_code_counts(min_encoding_indices))
+            z_q = self.embedding(min_encoding_indices).view(b, h, w, self.e_dim).permute(0, 3, 1, 2)
+            mse = torch.mean((z_q - z)**2)
+            loss = (1 + self.beta) * mse # both legacy modes agree without gradients
+            return z_q, loss, (perplexity, min_encodings, self.format_indices(min_encoding_indices, b, h, w))
+
         # reshape z -> (batch, height, width, channel) and flatten
         z = rearrange(z, 'b c h w -> b h w c').contiguous()
         z_flattened = z.view(-1, self.e_dim)
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.einsum('bd,dn->bn', z_flattened, rearrange(self.embedding.weight, 'n d -> d n'))
-
-        min_encoding_indices = torch.argmin(d, dim=1)
+        min_encoding_indices = self.get_nearest_indices(z_flattened, self.chunk_size)
         z_q = self.embedding(min_encoding_indices).view(z.shape)
-        perplexity = None
-        min_encodings = None
+        perplexity = self.record_usage(min_encoding_indices) if track_usage else self.get_perplexity(self.get_code_counts(min_encoding_indices))
 
         # compute loss for embedding
         if not self.legacy:
@@ -96,14 +221,7 @@ class VectorQuantizer2(nn.Module):
         # reshape back to match original input shape
         z_q = rearrange(z_q, 'b h w c -> b c h w').contiguous()
 
-        if self.remap is not None:
-            min_encoding_indices = min_encoding_indices.reshape(z.shape[0],-1) # add batch axis
-            min_encoding_indices = self.remap_to_used(min_encoding_indices)
-            min_encoding_indices = min_encoding_indices.reshape(-1,1) # flatten
-
-        if self.sane_index_shape:
-            min_encoding_indices = min_encoding_indices.reshape(
-                z_q.shape[0], z_q.shape[2], z_q.shape[3])
+        min_encoding_indices = self.format_indices(min_encoding_indices, z_q.shape[0], z_q.shape[2], z_q.shape[3])
 
         return z_q, loss, (perplexity, min_encodings, min_encoding_indices)
 
@@ -124,13 +242,47 @@ class VectorQuantizer2(nn.Module):
 
         return z_q
 
-    def get_codebook_entry_index(self, entry):
-        codebook_shape = self.embedding.weight.data.shape
+    # Keys of the rows of x (n, e_dim) for exact lookups. Accumulated one dimension at a time in float64,
+    # so a row gets the same key regardless of the tensor it is part of.
+    def get_row_keys(self, x):
+        weights = torch.rand(x.shape[1], dtype=torch.float64, generator=torch.Generator().manual_seed(0)) + 1
+        keys = torch.zeros(x.shape[0], dtype=torch.float64, device=x.device)
+        for d in range(x.shape[1]):
+            keys = keys + x[:, d].double() * weights[d].item()
+        return keys
 
-        assert entry.shape[1]==codebook_shape[1]
-        distance = torch.norm(self.embedding.weight.data - entry, dim=1)
-        
-        nearest = torch.argmin(distance)
-        nearest_distance = torch.min(distance)
+    # Nearest codebook entry and its euclidean distance for each row of entries (n, e_dim), searched chunk rows at a time.
+    # exact: entries are expected to be codebook vectors (e.g. quantized outputs). They are looked up by their
+    # hashed rows, and only the rows without an exact match are searched.
+    @torch.no_grad()
+    def get_codebook_entry_indices(self, entries, chunk=None, exact=False):
+        codebook = self.embedding.weight
+        assert entries.shape[1]==codebook.shape[1]
+        entries = entries.to(codebook)
+        indices = torch.zeros(entries.shape[0], dtype=torch.long, device=entries.device)
+        distances = torch.zeros(entries.shape[0], dtype=entries.dtype, device=entries.device)
+        searched = torch.ones(entries.shape[0], dtype=torch.bool, device=entries.device)
+
+        if exact:
+            # distinct keys and the first row of each, so duplicated rows resolve to the lowest index like argmin.
+            codebook_keys, key_groups = torch.unique(self.get_row_keys(codebook), sorted=True, return_inverse=True)
+            rows = torch.sort(key_groups*codebook.shape[0] + torch.arange(codebook.shape[0], device=codebook.device)).values
+            is_first = torch.ones_like(rows, dtype=torch.bool)
+            is_first[1:] = rows[1:]//codebook.shape[0] != rows[:-1]//codebook.shape[0]
+            first_rows = rows[is_first] % codebook.shape[0]
+            positions = torch.searchsorted(codebook_keys, self.get_row_keys(entries)).clamp(max=codebook_keys.shape[0]-1)
+            candidates = first_rows[positions]
+            found = torch.all(codebook[candidates] == entries, dim=1)
+            indices[found] = candidates[found]
+            searched = ~found
+
+        if searched.any():
+            nearest, nearest_distances = self.get_nearest_indices(entries[searched], chunk, return_distances=True)
+            indices[searched] = nearest
+            distances[searched] = nearest_distances.clamp(min=0).sqrt()
 
-        return nearest, nearest_distance
+        return indices, distances
+
+    def get_codebook_entry_index(self, entry):
+        nearest, nearest_distance = self.get_codebook_entry_indices(entry)
+        return nearest[0], nearest_distance[0]
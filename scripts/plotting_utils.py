@@ -12,6 +12,9 @@ from PIL import Image
 import json
 import csv
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+PREVIEW_DPI = 50
 
 
 def dump_to_json(dict, ckpt_path, name='results', get_fig_path=True):
@@ -115,11 +118,38 @@ def plot_heatmap(heatmap, ckpt_path=None, title='default', postfix=None):
     pd.DataFrame(heatmap.numpy()).to_csv(os.path.join(path, title+ " heat_map.csv"))
     
 
+# Renders one histogram grid. Runs in the pool workers, so it only gets plain arrays and strings.
+# job: (frequencies (locations, n_embed), titles, (rows, cols), file path, dpi)
+def _render_histogram_plot(job):
+    frequencies, titles, grid_shape, path, dpi = job
+    n_embed = frequencies.shape[-1]
+    fig, axs = plt.subplots(grid_shape[0], grid_shape[1], figsize = (5*grid_shape[1],30))
+    for i, ax in enumerate(axs.reshape(-1)):
+        ax.bar(np.arange(n_embed), frequencies[i], width=1.0)
+        ax.set_xlim(-0.5, n_embed-0.5)
+        ax.set_title(titles[i])
+    
+    fig.savefig(path,bbox_inches='tight',dpi=dpi)
+    plt.close(fig)
+    return path
+
+# Renders the jobs of Histogram_plotter.get_plot_job. num_workers > 0 spreads them over a process pool.
+def render_histogram_plots(jobs, num_workers=0):
+    jobs = [job for job in jobs if job is not None]
+    if num_workers > 0 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(_render_histogram_plot, jobs))
+    return [_render_histogram_plot(job) for job in jobs]
+
+
 class Histogram_plotter:
+    # preview: renders at PREVIEW_DPI into separate "_preview" files.
+    # Plots newer than source_path (e.g. the histogram store metadata) are up to date and skipped.
     def __init__(self, codes_per_phylolevel, n_phylolevels, n_embed, 
                  converter, 
                  indx_to_label,
-                 ckpt_path, directory):
+                 ckpt_path, directory,
+                 preview=False):
         self.codes_per_phylolevel = codes_per_phylolevel
         self.n_phylolevels = n_phylolevels
         self.n_embed = n_embed
@@ -127,19 +157,33 @@ class Histogram_plotter:
         self.ckpt_path = ckpt_path
         self.directory = directory
         self.indx_to_label = indx_to_label
+        self.preview = preview
         
-    def plot_histograms(self, histograms, species_indx, is_nonattribute=False, prefix="species"):
-        fig, axs = plt.subplots(self.codes_per_phylolevel, self.n_phylolevels, figsize = (5*self.n_phylolevels,30))
-        for i, ax in enumerate(axs.reshape(-1)):
-            ax.hist(histograms[i], density=True, range=(0, self.n_embed-1), bins=self.n_embed)
-            
+    def get_titles(self, is_nonattribute=False):
+        titles = []
+        for i in range(self.codes_per_phylolevel*self.n_phylolevels):
             if not is_nonattribute:
                 code_location, level = self.converter.get_code_reshaped_index(i)
-                ax.set_title("code "+ str(code_location) + "/level " +str(level))
+                titles.append("code "+ str(code_location) + "/level " +str(level))
             else:
-                ax.set_title("code "+ str(i))
-        
-        plt.show()
+                titles.append("code "+ str(i))
+        return titles
+    
+    def get_plot_path(self, species_indx, is_nonattribute=False, prefix="species"):
         sub_dir = 'attribute' if not is_nonattribute else 'non_attribute'
-        fig.savefig(os.path.join(get_fig_pth(self.ckpt_path, postfix=self.directory+'/'+sub_dir), "{}_{}_{}_hostogram.png".format(prefix, species_indx, self.indx_to_label[species_indx])),bbox_inches='tight',dpi=300)
-        plt.close(fig)
+        postfix = "_preview" if self.preview else ""
+        return os.path.join(get_fig_pth(self.ckpt_path, postfix=self.directory+'/'+sub_dir), "{}_{}_{}_hostogram{}.png".format(prefix, species_indx, self.indx_to_label[species_indx], postfix))
+    
+    # histograms: (locations, n_embed) counts. Returns None if the plot is up to date.
+    def get_plot_job(self, histograms, species_indx, is_nonattribute=False, prefix="species", source_path=None):
+        path = self.get_plot_path(species_indx, is_nonattribute, prefix)
+        if source_path is not None and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source_path):
+            return None
+        
+        counts = histograms.float().cpu().numpy()
+        frequencies = counts/np.maximum(counts.sum(axis=-1, keepdims=True), 1)
+        dpi = PREVIEW_DPI if self.preview else 300
+        return (frequencies, self.get_titles(is_nonattribute), (self.codes_per_phylolevel, self.n_phylolevels), path, dpi)
+        
+    def plot_histograms(self, histograms, species_indx, is_nonattribute=False, prefix="species", source_path=None):
+        render_histogram_plots([self.get_plot_job(histograms, species_indx, is_nonattribute, prefix, source_path)])